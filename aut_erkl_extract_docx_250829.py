@@ -4,55 +4,237 @@
 # The code is tailored to Danish records, but in principle all search terms can be modified to another language. The code is not very self-explanatory. Please contact me if you have any questions.
 # Feel free to modify the code for use on your own records and contact me with ideas for collaboration. This tool was developed specifically with the aspiration of multi-center cooperation studies, enabling large and diverse autopsy data sets.
 
-# This section imports revelant packages to Python.
+# This section imports revelant packages to Python. Heavy packages (python-docx, multiprocessing) are only imported when they are needed,
+# so the module can be imported in tests, notebooks and worker processes without starting a run.
 import os
 import re
 import csv
 import time
-from docx import Document
 from collections import OrderedDict
-import fitz # PyMuPDF
 
 
-def search_for_COD_keywords(doc_text, regex_dict):
-    paragraphs = re.split(r"\.\s*", doc_text)
-    found_keywords = {label: False for label in regex_dict}
+# Default settings - these can be changed with the command line arguments (see main() at the bottom of the script)
+default_folder_path = r"S:\RPA\7. Retspatologi\Andet\JOB_automatiskdataudtræk_CJW\Workspace\Primære erklæringer 1992-2024"
+#default_folder_path = r"S:\RPA\7. Retspatologi\Andet\JOB_automatiskdataudtræk_CJW\Workspace\test"
+default_keywords = ["Højre lunge", "Venstre lunge", "Hjerte", "Milt", "Leveren", "Hjernen", "Højre nyre", "Venstre nyre"]
+default_organ_keywords = ["Hjertet", "Leveren", "Højre nyre", "Venstre nyre"]
+default_output_csv_filename = "output_2025_08_26_supp.csv"
+default_keywordCT = "hjertepose" #Define keyword to look for in CT-paragraphs
+
+
+# Read a docx-file - python-docx is imported on first use
+def load_document(file_path):
+    from docx import Document
+    return Document(file_path)
+
+# The concatenated text of a document - the paragraph texts joined with spaces, with line breaks replaced by spaces
+def join_paragraphs(texts):
+    return " ".join([text.replace("\n", " ").replace("\r", " ") for text in texts])
+
+# This section is the paragraph cache. The reports are written from templates, so many paragraphs occur word for word in thousands of documents.
+# The paragraph-level extractors evaluate each paragraph with paragraph_result, which keeps the result for each (function, arguments, paragraph text)
+# in a bounded cache (the least recently used results are removed), so a repeated paragraph is only evaluated once per process.
+# The results can also be stored in an SQLite file (keyed by a hash of the function, arguments and paragraph text) and loaded in the next run.
+# The function is hashed with its code fingerprint (see _code_fingerprint) and the patterns in the arguments in full, so a changed function
+# or pattern does not get the stored results of the old one.
+
+# Maximum number of results in the cache in each process
+paragraph_cache_size = 200000
+
+_paragraph_cache = OrderedDict()  # (function, arguments, paragraph text): result
+_paragraph_cache_stats = {}  # function name: [hits, misses]
+_paragraph_cache_file = None  # persistent cache file used in this process
+_paragraph_cache_stored = {}  # hash: result, loaded from the persistent cache file
+_paragraph_cache_new = {}  # hash: result, not yet written to the persistent cache file
+_paragraph_scope_hashes = {}  # (function, arguments): hash of the function code fingerprint and arguments
+
+# Returns function(text, *args) - from the cache if the same function has been run on the same paragraph text with the same arguments.
+# The arguments must be hashable (e.g. compiled patterns or tuples) and the result must be JSON-compatible if the cache is stored in a file.
+def paragraph_result(function, text, *args):
+    key = (function, args, text)
+    stats = _paragraph_cache_stats.setdefault(function.__name__, [0, 0])
+    if key in _paragraph_cache:
+        _paragraph_cache.move_to_end(key)
+        stats[0] += 1
+        return _paragraph_cache[key]
+
+    stored_key = None
+    if _paragraph_cache_file is not None:
+        import hashlib
+
+        if (function, args) not in _paragraph_scope_hashes:
+            hasher = hashlib.blake2b(digest_size=8)
+            _code_fingerprint(function, set(), hasher)
+            hasher.update(_fingerprint_value(args).encode("utf-8"))
+            _paragraph_scope_hashes[(function, args)] = hasher.hexdigest()
+        stored_key = _paragraph_scope_hashes[(function, args)] + hashlib.blake2b(text.encode("utf-8"), digest_size=12).hexdigest()
+
+    if stored_key is not None and stored_key in _paragraph_cache_stored:
+        result = _paragraph_cache_stored[stored_key]
+        stats[0] += 1
+    else:
+        result = function(text, *args)
+        stats[1] += 1
+        if stored_key is not None:
+            _paragraph_cache_new[stored_key] = result
+
+    _paragraph_cache[key] = result
+    if len(_paragraph_cache) > paragraph_cache_size:
+        _paragraph_cache.popitem(last=False)
+    return result
+
+# Use a persistent paragraph cache file in this process - the stored results are loaded the first time
+def use_paragraph_cache_file(cache_file):
+    import json
+    import sqlite3
+
+    global _paragraph_cache_file
+    if cache_file is None or cache_file == _paragraph_cache_file:
+        return
+    _paragraph_cache_file = cache_file
+    _paragraph_cache_stored.clear()
+    connection = sqlite3.connect(cache_file, timeout=60)
+    connection.execute("CREATE TABLE IF NOT EXISTS paragraph_results (key TEXT PRIMARY KEY, result TEXT)")
+    for key, result in connection.execute("SELECT key, result FROM paragraph_results"):
+        # JSON has no tuples - the results are stored as lists and turned back into tuples
+        result = json.loads(result)
+        _paragraph_cache_stored[key] = tuple(result) if isinstance(result, list) else result
+    connection.close()
+
+# Write the new results to the persistent paragraph cache file
+def save_paragraph_cache():
+    import json
+    import sqlite3
+
+    if _paragraph_cache_file is None or not _paragraph_cache_new:
+        return
+    connection = sqlite3.connect(_paragraph_cache_file, timeout=60)
+    connection.execute("CREATE TABLE IF NOT EXISTS paragraph_results (key TEXT PRIMARY KEY, result TEXT)")
+    connection.executemany("INSERT OR IGNORE INTO paragraph_results VALUES (?, ?)",
+                           [(key, json.dumps(result, ensure_ascii=False)) for key, result in _paragraph_cache_new.items()])
+    connection.commit()
+    connection.close()
+    _paragraph_cache_stored.update(_paragraph_cache_new)
+    _paragraph_cache_new.clear()
+
+# Add the paragraph cache statistics from one process to the totals (function name: [hits, misses])
+def add_paragraph_cache_stats(totals, stats):
+    for name, (hits, misses) in stats.items():
+        total = totals.setdefault(name, [0, 0])
+        total[0] += hits
+        total[1] += misses
+
+def print_paragraph_cache_stats(stats):
+    for name, (hits, misses) in sorted(stats.items()):
+        print(f"Paragraph cache {name}: {hits} hits, {misses} misses ({100 * hits / max(hits + misses, 1):.1f}% hits)")
+
+
+
+# Generic windowed proximity search - units is a list of paragraph or sentence texts.
+# For every unit where anchor_pattern occurs, the following "window" units (and the anchor unit itself if include_anchor=True) are searched for the target patterns.
+# target_patterns is a dictionary of label: regex, and all targets are evaluated for all anchors in one pass, so overlapping windows are not rescanned.
+# per_unit=True searches each unit in the windows separately (each unit is scanned once, even if it is in several windows).
+# per_unit=False searches the text of each window joined with spaces, so a match may span several units (as in the COD search).
+# Returns a dictionary of label: True/False
+def proximity_search(units, anchor_pattern, target_patterns, window, include_anchor=False, per_unit=True, flags=re.IGNORECASE):
+    if isinstance(anchor_pattern, str):
+        anchor_pattern = re.compile(anchor_pattern, flags)
+    targets = {label: re.compile(pattern, flags) if isinstance(pattern, str) else pattern for label, pattern in target_patterns.items()}
+    found = {label: False for label in targets}
+    remaining = dict(targets)
+
+    if per_unit:
+        # Sliding window - a unit is covered if it is within "window" units after the latest anchor
+        covered_until = -1
+        target_items = tuple(targets.items())
+        for i, unit in enumerate(units):
+            is_anchor = paragraph_result(pattern_found, unit, anchor_pattern)
+            if i <= covered_until or (is_anchor and include_anchor):
+                for label in paragraph_result(patterns_found, unit, target_items):
+                    found[label] = True
+                    remaining.pop(label, None)
+                if not remaining:
+                    break
+            if is_anchor:
+                covered_until = i + window
+    else:
+        seen_windows = set()
+        for anchor_index, start, end in proximity_windows(units, anchor_pattern, window, include_anchor):
+            if (start, end) in seen_windows:
+                continue
+            seen_windows.add((start, end))
+            window_text = " ".join(units[start:end])
+            for label, pattern in list(remaining.items()):
+                if pattern.search(window_text):
+                    found[label] = True
+                    del remaining[label]
+            if not remaining:
+                break
 
-    for i, paragraph in enumerate(paragraphs):
-        if "dødsårsag" in paragraph.lower():
-            context = []
-            context.append(paragraph)
-            if i + 1 < len(paragraphs):
-                context.append(paragraphs[i + 1])
-            if i + 2 < len(paragraphs):
-                context.append(paragraphs[i + 2])
-            context_text = " ".join(context)
+    return found
 
-            for label, pattern in regex_dict.items():
-                if re.search(pattern, context_text, re.IGNORECASE):
-                    found_keywords[label] = True
+# Paragraph functions for paragraph_result - True if the pattern occurs in the text, and the labels of the (label, pattern) items that occur in the text
+def pattern_found(text, pattern):
+    return bool(pattern.search(text))
 
-    return found_keywords
+def patterns_found(text, items):
+    return tuple(label for label, pattern in items if pattern.search(text))
 
+# Returns the spans (start, end) of the parts of text between the matches of separator - the parts of separator.split(text)
+def split_spans(text, separator):
+    spans = []
+    position = 0
+    for match in separator.finditer(text):
+        spans.append((position, match.start()))
+        position = match.end()
+    spans.append((position, len(text)))
+    return spans
 
-def store_COD_text(doc_text):
-    COD_pattern = re.compile(r"\bdødsårsag\w*\b", re.IGNORECASE)
-    textCOD = []
+# Yields (anchor index, window start, window end) for every unit where anchor_pattern occurs - units[start:end] is the window
+def proximity_windows(units, anchor_pattern, window, include_anchor=False, flags=re.IGNORECASE):
+    if isinstance(anchor_pattern, str):
+        anchor_pattern = re.compile(anchor_pattern, flags)
+
+    for i, unit in enumerate(units):
+        if anchor_pattern.search(unit):
+            start = i if include_anchor else i + 1
+            yield i, start, min(i + window + 1, len(units))
+
+
+COD_anchor_pattern = re.compile(r"dødsårsag", re.IGNORECASE)
+
+# Search the sentence with "dødsårsag" and the next two sentences for the COD keywords
+def search_for_COD_keywords(doc_text, regex_dict):
     paragraphs = re.split(r"\.\s*", doc_text)
 
-    for i, paragraph in enumerate(paragraphs):
-        if COD_pattern.search(paragraph.lower()):
-            # Include the current paragraph
-            textCOD.append(paragraph)
-            # Include the next two paragraphs if they exist
-            if i + 1 < len(paragraphs):
-                textCOD.append(paragraphs[i + 1])
-            if i + 2 < len(paragraphs):
-                textCOD.append(paragraphs[i + 2])
-            textCOD = " ".join(textCOD)
-            break
+    return proximity_search(paragraphs, COD_anchor_pattern, regex_dict, 2, include_anchor=True, per_unit=False)
+
 
-    return textCOD
+def store_COD_text(doc_text):
+    return COD_text_spans(doc_text)[0]
+
+# The COD text and where it is in doc_text (a list with one piece, the spans of the sentences and of the space after each "." - see text_reference).
+# Returns ([], None) if "dødsårsag" does not occur.
+def COD_text_spans(doc_text):
+    COD_pattern = re.compile(r"\bdødsårsag\w*\b", re.IGNORECASE)
+    textCOD = []
+    spans = None
+    sentence_spans = split_spans(doc_text, re.compile(r"\.\s*"))
+    paragraphs = [doc_text[start:end] for start, end in sentence_spans]
+
+    # Include the first paragraph with "dødsårsag" and the next two paragraphs if they exist
+    for anchor_index, start, end in proximity_windows(paragraphs, COD_pattern, 2, include_anchor=True):
+        textCOD = " ".join(paragraphs[start:end])
+        piece = []
+        for number in range(start, end):
+            if number > start:
+                separator = sentence_spans[number - 1][1] + 1
+                piece.append((separator, separator + 1))
+            piece.append(sentence_spans[number])
+        spans = [piece]
+        break
+
+    return textCOD, spans
 
 def store_vaccine_text(doc):
     vac_pattern = re.compile(r"\b(vaccin\w*)\b", re.IGNORECASE)
@@ -74,6 +256,10 @@ def store_vaccine_text(doc):
     return textVAC
 
 
+# Phrases that start a findesteds paragraph (see store_finde_text and findeomst)
+finde_phrases = ("af sagsakterne fremgår", "af disse papirer", "nu afdøde", "der foreligger rapport fra", "om hændelsesforløbet",
+                 "det fremgår af det foreliggende", "det fremgår", "af det foreliggende fremgår")
+
 def store_finde_text(doc):
     text_finde = ""
 
@@ -101,25 +287,22 @@ def store_finde_text(doc):
 
 def findeomst(doc, regex_dict):
     found_patterns = {label: False for label in regex_dict}
+    regex_items = tuple(regex_dict.items())
+    phrases = tuple(finde_phrases)
 
     for paragraph in doc.paragraphs:
-        para_text = paragraph.text.lower()
-        if (
-            paragraph.text.lower().startswith("af sagsakterne fremgår")
-            or paragraph.text.lower().startswith("af disse papirer")
-            or paragraph.text.lower().startswith("nu afdøde")
-            or paragraph.text.lower().startswith("der foreligger rapport fra")
-            or paragraph.text.lower().startswith("om hændelsesforløbet")
-            or paragraph.text.lower().startswith("det fremgår af det foreliggende")
-            or paragraph.text.lower().startswith("det fremgår")
-            or paragraph.text.lower().startswith("af det foreliggende fremgår")
-            ):
-            for label, pattern in regex_dict.items():
-                if re.search(pattern, paragraph.text, re.IGNORECASE):
-                    found_patterns[label] = True
+        for label in paragraph_result(findeomst_paragraph, paragraph.text, phrases, regex_items):
+            found_patterns[label] = True
                     
     return found_patterns
 
+# The labels of the findeomst patterns found in a findesteds paragraph (a paragraph starting with one of the phrases, see finde_phrases).
+# The phrases are an argument, so they are part of the paragraph cache key.
+def findeomst_paragraph(text, phrases, regex_items):
+    if not text.lower().startswith(phrases):
+        return ()
+    return tuple(label for label, pattern in regex_items if re.search(pattern, text, re.IGNORECASE))
+
 # Extract "kendte sygdomme", e.g. text in conclusion occurring between "efter det oplyste" and "mand|kvinde|pige|dreng"
 def kendtMed(doc):
     pattern = re.compile(r"((efter det oplyste)(.*?)(mand|kvinde|pige|dreng))", re.IGNORECASE | re.DOTALL)
@@ -135,56 +318,105 @@ def kendtMed(doc):
 
     return textKM
 
-def hjerteText(doc):
-    pattern_hjertepose = re.compile(r"((.*?)(hjerteposen)(.*?))", re.IGNORECASE | re.DOTALL)
-    pattern_complete = re.compile(r"((.*?)(hjerteposen)(.*?)(farven))", re.IGNORECASE | re.DOTALL)
-    pattern_farven = re.compile(r"((.*?)(farven))", re.IGNORECASE | re.DOTALL)
-
-    textHeart = ""
+# Anchors for the organ description index - each anchor name maps to a compiled pattern that is searched once per paragraph.
+# More anchors can be added here, and the corresponding description column in organ_description_columns, without adding more passes over the document.
+organ_anchors = {
+    "hjertepose": re.compile(r"hjerteposen", re.IGNORECASE),
+    "farven": re.compile(r"farven", re.IGNORECASE),
+    "legemspulsåren": re.compile(r"Legemspulsåren og"),
+    "halspulsårerne": re.compile(r"Halspulsårerne"),
+    "lungerne": re.compile(r"Lungerne"),
+    "leveren": re.compile(r"Leveren"),
+    "nyrerne": re.compile(r"Nyrerne"),
+}
+
+# Additional organ description columns - column name and the anchor to look up. The first paragraph with the anchor is stored.
+organ_description_columns = {
+    "Lungebeskrivelse": "lungerne",
+    "Leverbeskrivelse": "leveren",
+    "Nyrebeskrivelse": "nyrerne",
+}
+
+# Build the organ description index in a single pass over the paragraphs.
+# Returns a dictionary mapping each anchor name to a list of (paragraph number, paragraph text) for every paragraph where the anchor occurs.
+def build_organ_index(doc, anchors=None):
+    if anchors is None:
+        anchors = organ_anchors
+
+    organ_index = {name: [] for name in anchors}
+    anchor_items = tuple(anchors.items())
 
+    for i, paragraph in enumerate(doc.paragraphs):
+        text = paragraph.text
+        for name in paragraph_result(patterns_found, text, anchor_items):
+            organ_index[name].append((i, text))
+
+    return organ_index
+
+# Returns the text of the first (or last) paragraph with the given anchor, or "" if the anchor does not occur
+def organ_index_text(organ_index, anchor, last=False):
+    hits = organ_index.get(anchor)
+    if not hits:
+        return ""
+    if last:
+        return hits[-1][1]
+    return hits[0][1]
+
+# Start position of each paragraph in the concatenated document text (see join_paragraphs)
+def paragraph_starts(doc):
+    starts = []
+    position = 0
     for paragraph in doc.paragraphs:
-        match = pattern_complete.search(paragraph.text)
-        if match:
-            textHeart = paragraph.text
-            break
+        starts.append(position)
+        position += len(paragraph.text) + 1
+    return starts
 
-    for paragraph in doc.paragraphs:
-        match = pattern_hjertepose.search(paragraph.text)
-        if match:
-            textHeart = paragraph.text
-            for paragraph in doc.paragraphs:
-                match = pattern_farven.search(paragraph.text)
-                if match:
-                    textHeart += paragraph.text + " "
-                    break
+# Where organ_index_text took its text from in the document text - a list with one piece (see text_reference), or None if the anchor does not occur
+def organ_index_spans(organ_index, anchor, starts, last=False):
+    hits = organ_index.get(anchor)
+    if not hits:
+        return None
+    number, text = hits[-1] if last else hits[0]
+    return [[(starts[number], starts[number] + len(text))]]
+
+# Heart description: the last paragraph with "hjerteposen" followed by the first paragraph with "farven" (this is what the previous nested paragraph loops returned)
+def hjerteText(doc, organ_index=None):
+    if organ_index is None:
+        organ_index = build_organ_index(doc)
+
+    textHeart = organ_index_text(organ_index, "hjertepose", last=True)
+
+    if textHeart and organ_index["farven"]:
+        textHeart += organ_index_text(organ_index, "farven") + " "
 
     return textHeart
 
-def aortaText(doc):
-    pattern_aorta = re.compile(r"Legemspulsåren og")
+# Where hjerteText took its text from - the two paragraphs and the space after the second one
+def hjerteSpans(organ_index, starts):
+    spans = organ_index_spans(organ_index, "hjertepose", starts, last=True)
+    if spans and organ_index["farven"]:
+        (start, end), = organ_index_spans(organ_index, "farven", starts)[0]
+        spans[0] += [(start, end), (end, end + 1)]
+    return spans
 
-    textAorta = ""
+def aortaText(doc, organ_index=None):
+    if organ_index is None:
+        organ_index = build_organ_index(doc)
 
-    for paragraph in doc.paragraphs:
-        match = pattern_aorta.search(paragraph.text)
-        if match:
-            textAorta = paragraph.text
-            break
-        
-    return textAorta
+    return organ_index_text(organ_index, "legemspulsåren")
 
-def carotidText(doc):
-    pattern_carotid = re.compile(r"Halspulsårerne")
+def carotidText(doc, organ_index=None):
+    if organ_index is None:
+        organ_index = build_organ_index(doc)
 
-    textCarotid = ""
+    return organ_index_text(organ_index, "halspulsårerne")
 
-    for paragraph in doc.paragraphs:
-        match = pattern_carotid.search(paragraph.text)
-        if match:
-            textCarotid = paragraph.text
-            break
-        
-    return textCarotid
+# Look up the additional organ description columns in the index
+def organ_description_text(organ_index, columns=None):
+    if columns is None:
+        columns = organ_description_columns
+
+    return {column: organ_index_text(organ_index, anchor).replace("\n", " ") for column, anchor in columns.items()}
 
 # Extract paragraph text where "skumsvamp" occurs - negative lookbehind removes any case, where "skumsvamp" is preceded by either "ingen" or "ikke" or "eller"
 def skumsvampPara(doc):
@@ -194,7 +426,7 @@ def skumsvampPara(doc):
     num = 0
 
     for paragraph in doc.paragraphs:
-        match = skum_pattern.search(paragraph.text)
+        match = paragraph_result(pattern_found, paragraph.text, skum_pattern)
         if match:
             num = num + 1
             if num < 2:
@@ -205,17 +437,24 @@ def skumsvampPara(doc):
     return skum_para
 
 # Extract sentence where "strip" occurs, adds each occurence to a single string, with " / " between each.
-def stripPara(doc):
+# numbers are the paragraph numbers from strip_paragraph_numbers (None = they are looked up).
+def stripPara(doc, numbers=None):
+    if numbers is None:
+        numbers = strip_paragraph_numbers(doc)
+    return "".join(" / " + doc.paragraphs[number].text for number in numbers)
+
+# The numbers of the paragraphs where "strip" occurs
+def strip_paragraph_numbers(doc):
     strip_pattern = re.compile(r"strip", re.IGNORECASE)
 
-    strip_text = ""
+    numbers = []
 
-    for paragraph in doc.paragraphs:
-        match = strip_pattern.search(paragraph.text)
+    for number, paragraph in enumerate(doc.paragraphs):
+        match = paragraph_result(pattern_found, paragraph.text, strip_pattern)
         if match:
-            strip_text = strip_text + " / " + paragraph.text
+            numbers.append(number)
 
-    return strip_text
+    return numbers
     
 
 # Extract paragraph text where "tegn på sygdom" occurs
@@ -226,15 +465,8 @@ def search_TPS(doc):
     TPS_para = None
 
     for paragraph in doc.paragraphs:
-        
-        match_iTPS = iTPS_pattern.search(paragraph.text)
-        if match_iTPS:
-            TPS_para = "ingen tegn på sygdom"
-            break
-        
-        match = TPS_pattern.search(paragraph.text)
-        if match:
-            TPS_para = match.group(1)
+        TPS_para = paragraph_result(TPS_paragraph, paragraph.text, TPS_pattern, iTPS_pattern)
+        if TPS_para is not None:
             break
 
     if TPS_para is not None:    
@@ -243,224 +475,198 @@ def search_TPS(doc):
         print ("TPS pattern not found")
         return "TPS pattern not found"
 
-def CT_search(doc, keywordCT):
-
-    keyCT = False
-
-    # Loop through paragraphs for "CT"
-    for i, paragraph in enumerate(doc.paragraphs):
-        if re.search(r"CT", paragraph.text, re.IGNORECASE):
-            # Check the next four paragraphs for keywordCT
-            for j in range(i + 1, min(i + 4, len(doc.paragraphs))):
-                if re.search(r"\b{}\w*\b".format(re.escape(keywordCT)), doc.paragraphs[j].text, re.IGNORECASE):
-                    print("*" + str(keywordCT) + "*" + " found in CT paragraphs")
-                    keyCT = True
-                    break
-
-    return keyCT
-
-
-def extract_lung_weights(text, keywords):
-    # Constructing the regular expression pattern dynamically from the list of keywords
-
-    keyword_pattern = "|".join([re.escape(keyword) for keyword in keywords])
-    pattern = re.compile(
-        rf"({keyword_pattern})(?![^.]*(?:blodans|bris|væskeans|hjertepose))[^.]*?(?:ca\.)?[^.]*?(\d{{2,4}})\s*(?:gram|g)", re.IGNORECASE  #replacing "[^.]*?" with "(?:(?:[^.]*\.){0,1}[^.]*)?" allows 1 dot, but does not work right now. 
-    )
-
-    """# Search for all matches in the text, only after character number 2000, i.e. skips the conclusion and introduction (should fit almost all documents)
-    matches = pattern.findall(text[2500:])"""
-
-    # 26th August 2024 - This updated regex may allow for bypassing extra weights in the sentences, e.g. "blodansanmling der vejer 30 g" - but it does not work with findall - needs solution:
-    # ({keyword_pattern})(?![^.]*(blodans|bris|væskeans))[^.]*?(\d{{2,4}}) (?:gram|g)
-    # 15th August 2025 - Added [^.]*?(?:ca\.)? to the regex. This adds the non-capturing group "ca." to allow for the word "ca." to occur zero or one times. Thus "." is still not permitted, except when part of "ca."
+# The TPS text of a paragraph - "ingen tegn på sygdom", the text after "tegn på sygdom", or None if the phrase is not in the paragraph
+def TPS_paragraph(text, TPS_pattern, iTPS_pattern):
+    match_iTPS = iTPS_pattern.search(text)
+    if match_iTPS:
+        return "ingen tegn på sygdom"
 
-    # Phrase to start searching from (case insensitive)
-    start_phrase = "Indvendig undersøgelse"
+    match = TPS_pattern.search(text)
+    if match:
+        return match.group(1)
+    return None
 
-    # Search for start phrase and store it as a start position
-    start_position = text.find(start_phrase)
+CT_anchor_pattern = re.compile(r"CT", re.IGNORECASE)
 
-    try:
-        if start_position != -1:
-            relevant_text = text[start_position:]
-
-            # Search for all matches in the text, only after start phrase (i.e. skips conclusion, introduction, CT, udvendig undersøgelse)
-            matches = pattern.findall(relevant_text)
-
-            # Create a dictionary to store the weights associated with the keywords
-            weights = {}
-            for match in matches:
-                keyword, weight = match
-                # Convert weight to integer
-                weight = int(weight)
-                keyword = keyword.lower()
-                weights.setdefault(keyword, weight)
-
-            return weights
-
-        else:
-            relevant_text = text[2500:]
-
-            # Search for all matches in the text, only after start phrase (i.e. skips conclusion, introduction, CT, udvendig undersøgelse)
-            matches = pattern.findall(relevant_text)
-
-            # Create a dictionary to store the weights associated with the keywords
-            weights = {}
-            for match in matches:
-                keyword, weight = match
-                # Convert weight to integer
-                weight = int(weight)
-                keyword = keyword.lower()
-                weights.setdefault(keyword, weight)
-
-            return weights
-    except Exception as e:
-        print(f"Error processing weights")
-
-def extract_organ_size(text, keywords):
-    # Constructing the regular expression pattern dynamically from the list of keywords
-
-    keyword_pattern = "|".join([re.escape(keyword) for keyword in keywords])
-    pattern = re.compile(
-        rf"({keyword_pattern})[^.]*?måler (\d+|\d+,\d+) x (\d+|\d+,\d+) x (\d+|\d+,\d+) cm", re.IGNORECASE  #Should match "[keyword] måler 12 x 12 x 12 cm" - commas should be accepted
-    )
-
-    """# Search for all matches in the text, only after character number 2000, i.e. skips the conclusion and introduction (should fit almost all documents)
-    matches = pattern.findall(text[2500:])"""
-
-    # Phrase to start searching from (case insensitive)
-    start_phrase = "Indvendig undersøgelse"
-
-    # Search for start phrase and store it as a start position
-    start_position = text.find(start_phrase)
-
-
-    try:
-        if start_position != -1:
-            relevant_text = text[start_position:]
-
-            # Search for all matches in the text, only after start phrase (i.e. skips conclusion, introduction, CT, udvendig undersøgelse)
-            matches = pattern.findall(relevant_text)
+# Look for each keyword in the three paragraphs following paragraphs with "CT" - returns a dictionary of keyword: True/False
+def CT_search_keywords(doc, keywordsCT):
+    targets = {keywordCT: r"\b{}\w*\b".format(re.escape(keywordCT)) for keywordCT in keywordsCT}
+    paragraphs = [paragraph.text for paragraph in doc.paragraphs]
 
-            # Create a dictionary to store the sizes associated with the keywords, all four groups must be matched, otherwise no match is made
-            sizes = {}
-            for match in matches:
-                organ, height, width, depth = match
-                # Convert comma-decimal values to float-compatible dot-decimals
-                sizes[f"{organ}_højde"] = float(height.replace(",", "."))
-                sizes[f"{organ}_bredde"] = float(width.replace(",", "."))
-                sizes[f"{organ}_dybde"] = float(depth.replace(",", "."))
+    keyCT = proximity_search(paragraphs, CT_anchor_pattern, targets, 3)
+    for keywordCT, found in keyCT.items():
+        if found:
+            print("*" + str(keywordCT) + "*" + " found in CT paragraphs")
 
-            return sizes
+    return keyCT
 
+def CT_search(doc, keywordCT):
+    return CT_search_keywords(doc, [keywordCT])[keywordCT]
+
+
+# This section is the measurement tokenizer. It replaces five extractors that each scanned the text with their own quantity regexes - the text is scanned
+# once for every number + unit (g/gram, kg/kilo, cm, mm, ml, "a x b x c cm" dimensions, comma decimals, with or without "ca."), every keyword
+# (organs and other anatomical words) and every sentence boundary. Each quantity is then attributed to the nearest relevant keyword before it in the same sentence:
+#   organ weights (g/gram) and organ sizes ("måler a x b x c cm") - only after "Indvendig undersøgelse" (or after character 2500 if the phrase is missing), as before.
+#                   Weights follow the findall of the old weight regex: a keyword takes the first weight after it in the sentence, and keywords between
+#                   the two are skipped ("Hjertet og leveren vejer 300 g og 1800 g" only gives hjerte). A keyword followed anywhere in the sentence by
+#                   blodans, bris, væskeans or hjertepose is not used.
+#   wall thicknesses (mm)
+#   pleural fluid (ml) - the nearest keyword before or after the volume, within the part of the sentence between commas and "og" (as the old pleural fluid extractor split the sentences)
+#   height (cm) and body weight (kg/kilo) - directly after "Højde[n] [er]" and "vægt[en] [er]" as before; a body weight in g may come later in the sentence
+# The first value for each keyword is used, except organ sizes and pleural fluid where the last value is used (as in the previous extractors).
+# tests/test_measurements.py has the expected values for typical sentences, and the sentences where the results differ from the old regexes.
+
+thickness_keywords = ["højre hjertekammer", "venstre hjertekammer", "hjerteskille"]
+pleural_fluid_keywords = ["højre", "venstre", "bughule"]
+body_keywords = ["højde", "vægt"]
+measurement_exclusions = ["blodans", "bris", "væskeans", "hjertepose"]
+
+# A number directly after digits and a "." or "," is the end of a larger number (e.g. "800" in "1.800 g") and is not a quantity of its own
+measurement_number = r"\d+(?:,\d+)?"
+measurement_quantity_pattern = (
+    rf"(?P<ca>\bca\.\s*)?(?<![\d,])(?<!\d\.)(?P<a>{measurement_number})(?:\s*x\s*(?P<b>{measurement_number})\s*x\s*(?P<c>{measurement_number}))?"
+    r"\s*(?P<unit>gram|g|kg|kilo|cm|mm|ml)\b"
+)
+
+# Text allowed between "højde"/"vægt" and the height or body weight in kg (the "n", "en" and "er" of the old height and weight regexes)
+measurement_body_gap = re.compile(r"(?:e?n)?(?: er)?\s")
+
+# Text directly before an organ size, so other dimensions in the sentence (e.g. of a hematoma) are not taken as the organ size
+measurement_size_prefix = re.compile(r"måler\s", re.IGNORECASE)
+
+# Compiled tokenizer patterns for each combination of keyword lists
+measurement_pattern_cache = {}
+
+def _measurement_pattern(keyword_lists):
+    cache_key = tuple(tuple(keyword_list) for keyword_list in keyword_lists.values())
+    if cache_key not in measurement_pattern_cache:
+        all_keywords = sorted({keyword.lower() for keyword_list in keyword_lists.values() for keyword in keyword_list}, key=len, reverse=True)
+        # The lookahead at the start only lets the regex try the alternatives at characters where a token can start, which makes the scan much faster
+        first_characters = {word[0].lower() for word in all_keywords + measurement_exclusions} | {"c", "o"}
+        first_characters |= {character.upper() for character in first_characters}
+        pattern = re.compile(
+            rf"(?=[\d.,{re.escape(''.join(sorted(first_characters)))}])"
+            r"(?:(?P<boundary>(?<!\bca)\.(?!\d))"
+            r"|(?P<fragment>,(?!\d)|(?<=\s)og(?=\s))"
+            rf"|(?P<quantity>{measurement_quantity_pattern})"
+            rf"|(?P<exclusion>{'|'.join(re.escape(word) for word in measurement_exclusions)})"
+            rf"|(?P<keyword>{'|'.join(re.escape(keyword) for keyword in all_keywords)}))",
+            re.IGNORECASE,
+        )
+        # For each keyword found in the text: the keyword it stands for in each keyword list (a keyword also matches longer words, e.g. "Hjerte" in "Hjertet")
+        keyword_map = {}
+        for found in all_keywords:
+            keyword_map[found] = {}
+            for list_name, keyword_list in keyword_lists.items():
+                matches = [keyword for keyword in keyword_list if found.startswith(keyword.lower())]
+                if matches:
+                    keyword_map[found][list_name] = max(matches, key=len)
+        measurement_pattern_cache[cache_key] = (pattern, keyword_map)
+    return measurement_pattern_cache[cache_key]
+
+def _measurement_value(number):
+    if "," in number:
+        return float(number.replace(",", "."))
+    return int(number)
+
+# Scan the text once - returns a list of sentences, each a list of tokens:
+#   ("keyword", position, {list name: keyword}, end), ("exclusion", position), ("fragment", position) and ("quantity", position, unit, values, ca)
+def tokenize_measurements(text, keyword_lists):
+    pattern, keyword_map = _measurement_pattern(keyword_lists)
+    sentences = [[]]
+
+    for match in pattern.finditer(text):
+        kind = match.lastgroup
+        if kind == "boundary":
+            sentences.append([])
+        elif kind == "fragment":
+            sentences[-1].append(("fragment", match.start()))
+        elif kind == "exclusion":
+            sentences[-1].append(("exclusion", match.start()))
+        elif kind == "keyword":
+            sentences[-1].append(("keyword", match.start(), keyword_map[match.group("keyword").lower()], match.end()))
         else:
-            relevant_text = text[2500:]
-
-            # Search for all matches in the text, only after start phrase (i.e. skips conclusion, introduction, CT, udvendig undersøgelse)
-            matches = pattern.findall(relevant_text)
-
-            # Create a dictionary to store the weights associated with the keywords
-            sizes = {}
-            for match in matches:
-                organ, height, width, depth = match
-                # Convert comma-decimal values to float-compatible dot-decimals
-                sizes[f"{organ}_højde"] = float(height.replace(",", "."))
-                sizes[f"{organ}_bredde"] = float(width.replace(",", "."))
-                sizes[f"{organ}_dybde"] = float(depth.replace(",", "."))
-
-            return sizes
-    except Exception as e:
-        print(f"Error processing weights")
-
-    
-def extract_wall_thicknesses(text, keywords):
-    # Constructing the regular expression pattern dynamically from the list of keywords
-    keyword_pattern = "|".join([re.escape(keyword) for keyword in keywords])
-    pattern = re.compile(rf"({keyword_pattern}).*?(\d{{1,2}}) mm", re.IGNORECASE)
-
-    # Create a dictionary to store the thicknesses associated with the keywords
+            values = [_measurement_value(match.group(group)) for group in ("a", "b", "c") if match.group(group)]
+            sentences[-1].append(("quantity", match.start(), match.group("unit").lower(), values, bool(match.group("ca"))))
+
+    return sentences
+
+# All measurement columns from one scan of the text: organ weights, organ sizes, wall thicknesses, pleural fluid volumes, height and body weight
+def extract_measurements(text, keywords, organ_keywords, thicknesses_keywords=None, fluid_keywords=None):
+    if thicknesses_keywords is None:
+        thicknesses_keywords = thickness_keywords
+    if fluid_keywords is None:
+        fluid_keywords = pleural_fluid_keywords
+    keyword_lists = {"weight": keywords, "size": organ_keywords, "thickness": thicknesses_keywords, "fluid": fluid_keywords, "body": body_keywords}
+
+    # Weights and sizes are only taken from the internal examination
+    start_position = text.find("Indvendig undersøgelse")
+    if start_position == -1:
+        start_position = 2500
+
+    weights = {}
+    sizes = {}
     thicknesses = {}
-
-    # Search for matches in the text
-    for sentence in re.split(r"\.\s*", text):
-        matches = pattern.findall(sentence)
-        for match in matches:
-            keyword, thickness = match
-            # Check if thickness is not an empty string
-            if thickness:
-                thicknesses.setdefault(keyword.lower(), int(thickness))
-
-    return thicknesses
-
-def extract_pleural_fluid(text, keywords):
-    # Constructing the regular expression pattern dynamically from the list of keywords
-    keyword_pattern = "|".join([re.escape(keyword) for keyword in keywords])
-    pattern = re.compile(rf"(\d{{1,4}}) ml.*?({keyword_pattern})|({keyword_pattern}).*?(\d{{1,4}}) ml", re.IGNORECASE)
-
-    # Create a dictionary to store the volumes associated with the keywords
-    volumes = {keyword: None for keyword in keywords}
-
-    # Search for matches in the text (split up sentences by "." ; "," and "og"
-    for sentence in re.split(r"[.]\s*|\s+og\s+|[,]", text, flags = re.IGNORECASE):
-        matches = pattern.findall(sentence)
-        for match in matches:
-            if match[0] and match[1]:
-                # Case: "200 ml væske i højre lungehule"
-                volume = int(match[0])
-                keyword = match[1].lower()
-            elif match[2] and match[3]:
-                # Case: "I højre lungehule ses 200 ml væske"
-                volume = int(match[3])
-                keyword = match[2].lower()
-            else:
+    volumes = {keyword: None for keyword in fluid_keywords}
+    height = None
+    body_weights = {}
+
+    for sentence in tokenize_measurements(text, keyword_lists):
+        # Keywords before the last exclusion word in the sentence are not used for weights
+        exclusions = [token[1] for token in sentence if token[0] == "exclusion"]
+        last_exclusion = exclusions[-1] if exclusions else -1
+        # Weight keyword waiting for its weight - the first usable keyword since the last weight
+        pending_weight = None
+        # Nearest keyword so far in the sentence, for each keyword list - (keyword, position, end)
+        nearest = {}
+        for token in sentence:
+            if token[0] == "keyword":
+                for list_name, keyword in token[2].items():
+                    nearest[list_name] = (keyword, token[1], token[3])
+                if "weight" in token[2] and pending_weight is None and token[1] >= start_position and token[1] > last_exclusion:
+                    pending_weight = token[2]["weight"]
+            elif token[0] == "quantity":
+                position, unit, values = token[1], token[2], token[3]
+                if unit in ("g", "gram") and len(values) == 1 and pending_weight and isinstance(values[0], int) and 10 <= values[0] < 10000:
+                    weights.setdefault(pending_weight.lower(), values[0])
+                    pending_weight = None
+                if unit == "cm" and len(values) == 3 and measurement_size_prefix.fullmatch(text, max(position - 6, 0), position):
+                    organ = nearest.get("size")
+                    if organ and organ[1] >= start_position:
+                        sizes[f"{organ[0]}_højde"] = float(values[0])
+                        sizes[f"{organ[0]}_bredde"] = float(values[1])
+                        sizes[f"{organ[0]}_dybde"] = float(values[2])
+                if unit == "mm" and len(values) == 1 and "thickness" in nearest:
+                    thicknesses.setdefault(nearest["thickness"][0].lower(), values[0])
+                body = nearest.get("body")
+                if body and len(values) == 1:
+                    adjacent = not token[4] and measurement_body_gap.fullmatch(text, body[2], position) is not None
+                    if body[0] == "højde" and unit == "cm" and adjacent and isinstance(values[0], int) and height is None:
+                        height = values[0]
+                    elif body[0] == "vægt" and unit in ("kg", "kilo") and adjacent:
+                        body_weights.setdefault("kg", int(round(values[0])))
+                    elif body[0] == "vægt" and unit in ("g", "gram"):
+                        body_weights.setdefault("g", int(round(values[0])))
+
+        # Pleural fluid - the nearest keyword before or after each volume, between commas and "og"
+        fragment = []
+        for token in sentence + [("fragment", None)]:
+            if token[0] != "fragment":
+                fragment.append(token)
                 continue
+            fluid_hits = [(hit[1], hit[2]["fluid"]) for hit in fragment if hit[0] == "keyword" and "fluid" in hit[2]]
+            for hit in fragment:
+                if hit[0] == "quantity" and hit[2] == "ml" and len(hit[3]) == 1 and fluid_hits:
+                    position, keyword = min(fluid_hits, key=lambda fluid_hit: abs(fluid_hit[0] - hit[1]))
+                    volumes[keyword] = int(round(hit[3][0]))
+            fragment = []
 
-            # Store the volume in the dictionary
-            if keyword in volumes:
-                volumes[keyword] = volume
-
-    return volumes
-
-def extract_height_weight(text):
-    # Define regular expression patterns for height and weight
-    height_pattern = re.compile(r"Højde(?:n)?(?: er)? (\d+)\s(cm)", re.IGNORECASE)
-    weight_pattern = re.compile(r"vægt(?:en)?(?: er)?\s((?:\d+,)?\d+)\s?(kg|kilo)(\.|,|\s)", re.IGNORECASE)
-    weight_pattern_g = re.compile(r"vægt(?:en)?(?: er)?.*?(\d+)\s?(g)(?:ram)?(\.|,|\s)", re.IGNORECASE)
-
-    #height_pattern = re.compile(r"Højden er (\d+).*?cm", re.IGNORECASE)
-    #weight_pattern = re.compile(r"vægten(?: er)? (\d+).*?(kg)", re.IGNORECASE)
-    #weight_pattern_g = re.compile(r"vægten(?: er)? (\d+).*?(g)", re.IGNORECASE)
+    # A body weight in kg is preferred over a weight in g (as before)
+    bod_weight_unit = "kg" if "kg" in body_weights else ("g" if "g" in body_weights else None)
+    bod_weight = body_weights.get(bod_weight_unit)
 
-    # Initialize variables to store height and weight
-    height = None
-    weight = None
-    weight_unit = None
-
-    # Search for height in the text
-    height_match = height_pattern.search(text)
-    if height_match:
-        height = int(height_match.group(1))
-
-    # Search for weight in the text
-    weight_match = weight_pattern.search(text)
-    weight_match_g = weight_pattern_g.search(text)
-    if weight_match:
-        weight = weight_match.group(1)
-        weight_unit = weight_match.group(2)
-        #Check for cases where weight is reported as decimal number, e.g. vægt 1,234 kg - if so, replace comma with dot (1.234), change to floating point number, round this number (1.234 -> 1) and convert to integer. 
-        if "," in weight:
-            weight = int(round(float(weight.replace(",", "."))))
-        else:
-            weight = int(weight)
-        if weight_unit == "kilo":
-            weight_unit = "kg"
-    elif weight_match_g:
-        weight = int(weight_match_g.group(1))
-        weight_unit = weight_match_g.group(2)
-
-    #print(height, weight, weight_unit)
-    return height, weight, weight_unit
+    return {**weights, **sizes, **thicknesses, **volumes, "Højde": height, "Vægt": bod_weight, "Vægtenhed": bod_weight_unit}
 
 
 def extract_cpr_number_from_table(doc):
@@ -521,6 +727,25 @@ def extract_aut_date_from_table(doc):
             return str(old_date_dd + "-" + old_date_match.group(3) + "-" + old_date_match.group(5))
             break
     return "No date"
+
+# Two-digit years up to date_century_pivot are 20xx, the rest 19xx (the reports are from 1992 and later)
+date_century_pivot = 50
+
+# Convert a date from extract_aut_date_from_table ("dd-mm-yyyy", "dd.mm.yy" etc.) to ISO format (yyyy-mm-dd).
+# ISO dates are returned as they are, and so are "No date" and dates that do not exist (e.g. 31-02-1995), so they can be found in the output.
+def normalize_date(date):
+    import datetime
+
+    match = re.fullmatch(r"(\d{1,2})[-.](\d{1,2})[-.](\d{4}|\d{2})", date.strip())
+    if not match:
+        return date
+    day, month, year = (int(group) for group in match.groups())
+    if len(match.group(3)) == 2:
+        year += 2000 if year <= date_century_pivot else 1900
+    try:
+        return datetime.date(year, month, day).isoformat()
+    except ValueError:
+        return date
                                       
 
     #Check if a certain word occurs in the text (this version also supports word part of a larger word, e.g. "økse"-keyword matches both "økse" and "øksehoved")
@@ -661,56 +886,63 @@ def putrefaction_degree(text):
     return sorted(found_levels, key=lambda x: priority[x])[0]
 
 
+#Age patterns - the first match of each pattern is used by age_from_matches
+age_patterns = {
+    "stillborn": re.compile(r"\bdødfødt(e)?"),
+    "newborn": re.compile(r"\bnyfødt(e)?"),
+    "age": re.compile(r"\b(\d{1,3})(?=-årig(e)?\b)", re.IGNORECASE),
+    "age_month": re.compile(r"\b(\d{1,3})(?= måneder gam(mel|le)?\b)", re.IGNORECASE),
+    "age_week": re.compile(r"\b(\d{1,2})(?= uger gam(mel|le)?\b)", re.IGNORECASE),
+    "age_day": re.compile(r"\b(\d{1,2})(?= dage gam(mel|le)?\b)", re.IGNORECASE),
+    "fetal_week": re.compile(r"\b(fosteruge) (\d{1,2})", re.IGNORECASE),
+}
+
 def extract_age(doc):
     #Extract age from conclusion
-    stillborn_pattern  = re.compile(r"\bdødfødt(e)?")
-    newborn_pattern = re.compile(r"\bnyfødt(e)?")
-    age_pattern = re.compile(r"\b(\d{1,3})(?=-årig(e)?\b)", re.IGNORECASE)
-    age_month_pattern = re.compile(r"\b(\d{1,3})(?= måneder gam(mel|le)?\b)", re.IGNORECASE)
-    age_week_pattern = re.compile(r"\b(\d{1,2})(?= uger gam(mel|le)?\b)", re.IGNORECASE)
-    age_day_pattern = re.compile(r"\b(\d{1,2})(?= dage gam(mel|le)?\b)", re.IGNORECASE)
-    fetal_week_pattern = re.compile(r"\b(fosteruge) (\d{1,2})", re.IGNORECASE)
+    return age_from_matches(first_matches(age_patterns, doc))
 
+#Age and age unit from the first match of each of the age_patterns (pattern name: match or None)
+def age_from_matches(matches):
     age = None
     age_unit = None
 
     
-    stillborn_match = stillborn_pattern.search(doc)
+    stillborn_match = matches["stillborn"]
     if stillborn_match:
         age = "."
         age_unit = "stillborn"
         return age, age_unit
 
-    newborn_match = newborn_pattern.search(doc)
+    newborn_match = matches["newborn"]
     if newborn_match:
         age = "."
         age_unit = "newborn"
         return age, age_unit
 
-    fetal_week_match = fetal_week_pattern.search(doc)
+    fetal_week_match = matches["fetal_week"]
     if fetal_week_match:
         age = fetal_week_match.group(2)
         age_unit = "fetal weeks"
         
-    age_month_match = age_month_pattern.search(doc)
+    age_month_match = matches["age_month"]
     if age_month_match:
         age = age_month_match.group(0)
         age_unit = "mon"
         return age, age_unit
 
-    age_week_match = age_week_pattern.search(doc)
+    age_week_match = matches["age_week"]
     if age_week_match:
         age = age_week_match.group(0)
         age_unit = "wk"
         return age, age_unit
 
-    age_day_match = age_day_pattern.search(doc)
+    age_day_match = matches["age_day"]
     if age_day_match:
         age = age_day_match.group(0)
         age_unit = "days"
         return age, age_unit
     
-    age_match = age_pattern.search(doc)
+    age_match = matches["age"]
     if age_match:
         age = age_match.group(0)
         age_unit = "yrs"
@@ -719,15 +951,18 @@ def extract_age(doc):
         
     return age, age_unit
 
+sex_patterns = {"sex": re.compile(r"(årig[^.]*(mand|kvinde))|((gammel|gamle|årige)[^.]*(dreng|pige))")}
+
 def extract_sex(text):
     #Extract gender from conclusion
-    sex_pattern = re.compile(r"(årig[^.]*(mand|kvinde))|((gammel|gamle|årige)[^.]*(dreng|pige))")
+    return sex_from_matches(first_matches(sex_patterns, text))
 
+def sex_from_matches(matches):
     sex = None
     sexAdult = None
     sexChild = None
 
-    sex_match = sex_pattern.search(text)
+    sex_match = matches["sex"]
     if sex_match:
         sexAdult = sex_match.group(2)
         sexChild = sex_match.group(5)
@@ -742,13 +977,16 @@ def extract_sex(text):
 
     return sex
 
+supp_patterns = {"supp": re.compile(r"\bsupplerende erklæring til(?: retslægelig)? obduktion|obduktion-supl\b", re.IGNORECASE)}
+
 def extract_supp(text):
     #Determine if record i primary or supplementary report
-    supp_pattern = re.compile(r"\bsupplerende erklæring til(?: retslægelig)? obduktion|obduktion-supl\b", re.IGNORECASE)
+    return supp_from_matches(first_matches(supp_patterns, text))
 
+def supp_from_matches(matches):
     supp = None
 
-    supp_match = supp_pattern.search(text)
+    supp_match = matches["supp"]
     if supp_match:
         supp = "Supp"
     else:
@@ -845,228 +1083,1878 @@ def extract_lesions(doc):
 
     return lesion_dict
 
-def process_documents(folder_path, keywords, keyword_COD, keyword_2_COD):
-    # Initialize a list to store dictionaries of data for each document
-    print("Processsing docx-documents!")
-    all_data = []
-    all_keys = OrderedDict()
-    num_files_processed = 0
-    total_time = 0
+# Dictionary of COD keywords and associated regexes - checked in the sentence with "dødsårsag" and the following two sentences
+COD_regex_dict = {
+    "uoplyst": r"ikke oplyst|uoplyst",
+    "drukning": r"drukning",
+    "hjertesvigt": r"akut hjertesvigt",
+    "forgiftning": r"forgiftning(?![^.]+(kulilte|cyanid))",
+    "hængning": r"hængning",
+    "skud": r"skudlæsion",
+    "stik_snit": r"stiklæsion|snitlæsion|stiksår|snitsår",
+    "forblødning": r"forblødning",
+    "forbrænding": r"forbrænding",
+    "lungebetændelse": r"lunge[^.]+betændelse|betændelse[^.]+lunge|lungebetændelse",
+    "ikke holdepunkt": r"ikke holdepunkt",
+    "supp_no_change": r"resultat[^.]+giver ikke|resultat[^.]+ændrer ikke",
+}
+
+# Findeomstændigheder - dictionary of terms and associated regexes, that are checked in paragraphs with phrases such as "af disse papirer", "nu afdøde", etc. - check the function for all terms
+findeomst_regex_dict = {
+    "fundet_i_vand": (
+        r"(fundet|livløs|\bfandt|liggende|ligget|lå|nedsunket|under|\bflydende\b|drivende|bunden|ude i vandet|fik i|trukket op|optaget i|spottet|bjerget|fisket op|reddet)"
+        r"(?:(?![.,:]\s).)+(\bflydende|druknet|drivende|i vandet|af vandet|i en å|\bå\b|\bbrønd\b|sivbrønd|sivområde|trawl|under vand|lavt vand|swimmingpool|vandkanten"
+        r"|vandoverfladen|vandhul|fra båden|bælt\b|vandløb|dam\b|fiskedam|\bsø\b|søen\b|gadekær|på bunden|havbunden|saltvandsbassin|havnebassin|drevet i land"
+        r"|vandhul|bundgarn|farvand|fjord|voldgrav|strandkanten|havet\b|havstokken|\bkanal|\bhavn(?!et))"
+    ),
+    "trafik": r"påkørt|fører af|passager\b|færdselsuheld|trafikuheld|trafikulykke"
+}
+
+
+# This section is the batch regex engine. The steps that only apply fixed patterns to the concatenated text (batch_steps) can be run on many documents
+# at once: the texts are joined with a separator, each pattern is searched in the joined text, and the matches are mapped back to
+# the documents with a binary search in the start offsets. After the first match in a document, the search continues at the start of the next document.
+# The first match in each document is the same as a search in the document alone -
+# the separator contains no word characters (so \b works as at the start and end of a text) and a "." (so [^.]* stops at the end of a text).
+# If a match still reaches into the separator or another document, those documents are searched alone.
+
+batch_separator = "\x00.\x00"
+
+autoerot_patterns = {"autoerot": re.compile(re.escape("autoerot"), flags = re.IGNORECASE)}
+
+# The first match of each pattern in one text - pattern name: match or None
+def first_matches(patterns, text):
+    return {name: pattern.search(text) for name, pattern in patterns.items()}
+
+# The first match of each pattern in each of the texts - returns a list of dictionaries (pattern name: match or None), one per text
+def batch_first_matches(patterns, texts):
+    from bisect import bisect_right
+
+    starts = []
+    position = 0
+    for text in texts:
+        starts.append(position)
+        position += len(text) + len(batch_separator)
+    joined = batch_separator.join(texts)
+
+    starts.append(position)
+
+    results = [dict.fromkeys(patterns) for text in texts]
+    for name, pattern in patterns.items():
+        search_alone = set()
+        match = pattern.search(joined)
+        while match:
+            number = bisect_right(starts, match.start()) - 1
+            if match.end() > starts[number] + len(texts[number]):
+                # The match goes beyond the end of the text - all texts it touches are searched alone
+                last = bisect_right(starts, match.end()) - 1
+                search_alone.update(range(number, min(last + 1, len(texts))))
+                number = last
+            else:
+                results[number][name] = match
+            match = pattern.search(joined, starts[number + 1]) if number + 1 < len(texts) else None
+        for number in search_alone:
+            results[number][name] = pattern.search(texts[number])
+    return results
+
+# Columns of the batch steps, made from the first match of each pattern
+def supp_columns(matches):
+    return {"Prim_status": supp_from_matches(matches)}
+
+def age_columns(matches):
+    age, age_unit = age_from_matches(matches)
+    return {"Age": age, "Age unit": age_unit}
+
+def sex_columns(matches):
+    return {"Sex": sex_from_matches(matches)}
+
+def autoerot_columns(matches):
+    return {"Autoerot": bool(matches["autoerot"])}
+
+
+# This section defines the extraction steps. Each step receives the document context "ctx" (the docx document, the concatenated text and the keyword settings)
+# and returns a dictionary of columns. The steps are run in the order of extraction_steps, which is also the order of the columns in the output.
+# A step that returns a long text column can also return "_spans:<column>", where the text was taken from in the concatenated text (see text_reference).
+# The spans are stored in the result cache with the columns, and extract_document removes them from the record.
+
+# Extract CPR number from table in the document
+def step_cpr(ctx):
+    return {"CPR Number": extract_cpr_number_from_table(ctx["doc"])}
+
+# Extract autopsy record number from table in the document
+def step_aut_number(ctx):
+    return {"aut_number": extract_aut_number_from_table(ctx["doc"])}
+
+# Extract if primary or supplementary report from the concatenated text
+def step_supp(ctx):
+    return supp_columns(first_matches(supp_patterns, ctx["doc_text"]))
+
+# Extract autopsy date from table in the document
+def step_aut_date(ctx):
+    return {"Autopsy Date": normalize_date(extract_aut_date_from_table(ctx["doc"]))}
+
+# Extract age from the concatenated text
+def step_age(ctx):
+    return age_columns(first_matches(age_patterns, ctx["doc_text"]))
+
+# Extract sex from the concatenated text
+def step_sex(ctx):
+    return sex_columns(first_matches(sex_patterns, ctx["doc_text"]))
+
+# Extract organ weights, organ sizes, wall thicknesses, pleural fluid volumes, height and weight from the concatenated text in one scan
+def step_measurements(ctx):
+    return extract_measurements(ctx["doc_text"], ctx["keywords"], ctx["organ_keywords"])
+
+# Extract putrefaction from the concatenated text
+def step_putrefaction(ctx):
+    return {"Putrefaction": extract_putrefaction(ctx["doc_text"])}
+
+# Extract putrefaction level from text
+def step_putre_level(ctx):
+    return {"Putre_level": putrefaction_degree(ctx["doc_text"])}
+
+# Extract keyword from text
+def step_autoerot(ctx):
+    return autoerot_columns(first_matches(autoerot_patterns, ctx["doc_text"]))
+
+# Check if COD keywords in the given list is present in the document
+def step_COD_keywords(ctx):
+    return search_for_COD_keywords(ctx["doc_text"], COD_regex_dict)
+
+# Look up COD paragraph and store whole paragraph as text variable
+def step_COD_text(ctx):
+    textCOD, spans = COD_text_spans(ctx["doc_text"])
+    return {"COD tekst": textCOD, "_spans:COD tekst": spans}
+
+# Look up findesteds paragraph and store whole paragraph as text variable
+def step_finde_text(ctx):
+    return {"Finde tekst": store_finde_text(ctx["doc"])}
+
+# Look up vaccination sentences and store each sentence as text variable - up to two sentences
+def step_vaccine_text(ctx):
+    return {"Vaccine text": store_vaccine_text(ctx["doc"]).replace("\n", " ")}
+
+# Findeomstændigheder - check the findeomst_regex_dict terms in the findesteds paragraphs
+def step_findeomst(ctx):
+    return findeomst(ctx["doc"], findeomst_regex_dict)
+
+# Look for keyCT in paragraphs with "CT" and following three paragraphs - keywordCT can be a single keyword or a list of keywords
+def step_CT(ctx):
+    keywordCT = ctx["keywordCT"]
+    keywordsCT = [keywordCT] if isinstance(keywordCT, str) else keywordCT
+    keyCT_present = CT_search_keywords(ctx["doc"], keywordsCT)
+    return {"keywordCT: "+str(key): found for key, found in keyCT_present.items()}
+
+# Look for "skumsvamp" in paragraphs and return all paragraphs where this is true
+def step_skumsvamp(ctx):
+    return {"Skumsvamp tekst": skumsvampPara(ctx["doc"])}
+
+# Look for "strip" in the whole document, return all paragraphs where "strip" is found as a single string
+def step_strip(ctx):
+    numbers = strip_paragraph_numbers(ctx["doc"])
+    starts = paragraph_starts(ctx["doc"])
+    return {
+        "Strip_text": stripPara(ctx["doc"], numbers),
+        "_spans:Strip_text": [[]] + [[(starts[number], starts[number] + len(ctx["doc"].paragraphs[number].text))] for number in numbers],
+    }
 
-    # List to store all paths for docx-files
-    docx_files = []
+# Look for "tegn på sygdom*" in paragraphs and return all text in paragraph after the phrase
+def step_TPS(ctx):
+    return {"TPS": search_TPS(ctx["doc"]).replace("\n", " ")}
+
+#Look for "efter det oplyste" and return subsequent text until finding "mand|kvinde"
+def step_kendt_med(ctx):
+    return {"Kendte sygdomme": kendtMed(ctx["doc"])}
+
+# Build the organ description index once and look up the heart, aorta, carotid and additional organ description columns in it
+def step_organ_descriptions(ctx):
+    organ_index = build_organ_index(ctx["doc"])
+    starts = paragraph_starts(ctx["doc"])
+    return {
+        "Hjertebeskrivelse": hjerteText(ctx["doc"], organ_index).replace("\n", " "),
+        "Aortabeskrivelse": aortaText(ctx["doc"], organ_index).replace("\n", " "),
+        "Carotider_beskrivelse": carotidText(ctx["doc"], organ_index).replace("\n", " "),
+        **organ_description_text(organ_index), # Unpack the additional organ description columns
+        "_spans:Hjertebeskrivelse": hjerteSpans(organ_index, starts),
+        "_spans:Aortabeskrivelse": organ_index_spans(organ_index, "legemspulsåren", starts),
+        "_spans:Carotider_beskrivelse": organ_index_spans(organ_index, "halspulsårerne", starts),
+        **{f"_spans:{column}": organ_index_spans(organ_index, anchor, starts) for column, anchor in organ_description_columns.items()},
+    }
+
+#Compile list of paragraphs with lesion data - not in use
+def step_lesions(ctx):
+    return extract_lesions(ctx["doc"])
+
+# List of (step name, step function) - the step name is used in the quarantine list when a step fails
+extraction_steps = [
+    ("cpr", step_cpr),
+    ("aut_number", step_aut_number),
+    ("supp", step_supp),
+    ("aut_date", step_aut_date),
+    ("age", step_age),
+    ("sex", step_sex),
+    ("measurements", step_measurements),
+    ("putrefaction", step_putrefaction),
+    ("putre_level", step_putre_level),
+    ("autoerot", step_autoerot),
+    ("COD_keywords", step_COD_keywords),
+    ("COD_text", step_COD_text),
+    ("finde_text", step_finde_text),
+    ("vaccine_text", step_vaccine_text),
+    ("findeomst", step_findeomst),
+    ("CT", step_CT),
+    ("skumsvamp", step_skumsvamp),
+    ("strip", step_strip),
+    ("TPS", step_TPS),
+    ("kendt_med", step_kendt_med),
+    ("organ_descriptions", step_organ_descriptions),
+    #("lesions", step_lesions),
+]
+
+# Steps that can be run on a batch of documents (see batch_first_matches) - step name: (patterns, function that makes the columns from the matches).
+# Each of these steps must give the same columns as the batch, i.e. columns(first_matches(patterns, ctx["doc_text"])).
+batch_steps = {
+    "supp": (supp_patterns, supp_columns),
+    "age": (age_patterns, age_columns),
+    "sex": (sex_patterns, sex_columns),
+    "autoerot": (autoerot_patterns, autoerot_columns),
+}
+
+# Steps that can only find something if one of their literals occurs in the document - step name: (literals, columns when none of them occur).
+# The lowercase literals are looked up in the lowercased document text, and if none of them occur, the step is not run and gets the columns
+# it returns for a document without a match. Each literal list must be found in every paragraph the step can match, e.g. the anchor words
+# of its patterns - so the steps that depend on the keyword settings (measurements, CT) or read the tables are not here.
+prefilter_steps = {
+    "putre_level": (["forrådnelse", "grønlig"], {"Putre_level": "NO MENTION"}),
+    "COD_keywords": (["dødsårsag"], {label: False for label in COD_regex_dict}),
+    "COD_text": (["dødsårsag"], {"COD tekst": []}),
+    "finde_text": (list(finde_phrases), {"Finde tekst": ""}),
+    "vaccine_text": (["vaccin"], {"Vaccine text": ""}),
+    "findeomst": (list(finde_phrases), {label: False for label in findeomst_regex_dict}),
+    "skumsvamp": (["skumsvamp"], {"Skumsvamp tekst": ""}),
+    "strip": (["strip"], {"Strip_text": ""}),
+    "TPS": (["tegn på sygdom"], {"TPS": "TPS pattern not found"}),
+    "kendt_med": (["efter det oplyste"], {"Kendte sygdomme": ""}),
+    "organ_descriptions": (
+        ["hjerteposen", "farven", "legemspulsåren og", "halspulsårerne", "lungerne", "leveren", "nyrerne"],  # the organ_anchors
+        {"Hjertebeskrivelse": "", "Aortabeskrivelse": "", "Carotider_beskrivelse": "", **{column: "" for column in organ_description_columns}},
+    ),
+}
+
+# This section is the result cache. The result of each extraction step is stored in an SQLite file, keyed by the hash of the document content
+# and a fingerprint of the step. The fingerprint is taken from the source code of the step function and of all functions, patterns and settings
+# it uses (recursively), so when a pattern is changed only the steps that use it are run again. The cache has a size limit - when it is exceeded,
+# the least recently used results are removed.
+
+# Open cache connections in this process - cache file: connection
+_result_cache_connections = {}
+
+# Number of documents stored in each cache by this process - cache file: count
+_result_cache_puts = {}
+
+# Step fingerprints in this process - step name: fingerprint
+_step_fingerprints = {}
+
+# Module-level names that hold state which changes while the program runs (caches, statistics, open connections) - they are not part of the fingerprint
+fingerprint_exclusions = {
+    "_paragraph_cache", "_paragraph_cache_stats", "_paragraph_cache_file", "_paragraph_cache_stored", "_paragraph_cache_new", "_paragraph_scope_hashes",
+    "measurement_pattern_cache", "_result_cache_connections", "_result_cache_puts", "_step_fingerprints", "_text_store_connections", "_text_store_pending",
+}
+
+# Text for a module-level value in the fingerprint - compiled patterns are written out in full (their repr is cut off after 200 characters)
+def _fingerprint_value(value):
+    if isinstance(value, re.Pattern):
+        return f"re.compile({value.pattern!r}, {int(value.flags)})"
+    if isinstance(value, dict):
+        return "{" + ", ".join(f"{key!r}: {_fingerprint_value(item)}" for key, item in value.items()) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_fingerprint_value(item) for item in value) + "]"
+    if isinstance(value, (set, frozenset)):
+        return "{" + ", ".join(sorted(_fingerprint_value(item) for item in value)) + "}"
+    return repr(value)
+
+# Hash of everything a function depends on - its source code, and the functions and module-level values (patterns, keyword lists, dictionaries) it refers to
+def _code_fingerprint(function, seen, hasher):
+    import inspect
+
+    if function.__name__ in seen:
+        return
+    seen.add(function.__name__)
+
+    try:
+        hasher.update(inspect.getsource(function).encode("utf-8"))
+    except (OSError, TypeError):
+        hasher.update(function.__code__.co_code)
+
+    # Names used in the function, including comprehensions and inner functions
+    names = set()
+    codes = [function.__code__]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes += [const for const in code.co_consts if hasattr(const, "co_names")]
+
+    for name in sorted(names):
+        if name in fingerprint_exclusions or name not in globals():
+            continue
+        value = globals()[name]
+        if callable(value) and getattr(value, "__module__", None) == __name__ and hasattr(value, "__code__"):
+            _code_fingerprint(value, seen, hasher)
+        elif isinstance(value, (re.Pattern, str, int, float, list, tuple, dict, set, frozenset)):
+            hasher.update(f"{name}={_fingerprint_value(value)}".encode("utf-8"))
+
+# Fingerprint of an extraction step, including the ctx settings it uses (e.g. ctx["keywords"]). It also covers the code that makes the document
+# text and the step's entry in prefilter_steps, which decides if the step is run at all.
+def step_fingerprint(step_name, step, ctx):
+    import hashlib
+    import inspect
+
+    if step_name not in _step_fingerprints:
+        hasher = hashlib.sha1()
+        seen = set()
+        _code_fingerprint(step, seen, hasher)
+        _code_fingerprint(join_paragraphs, seen, hasher)
+        hasher.update(f"prefilter={_fingerprint_value(prefilter_steps.get(step_name))}".encode("utf-8"))
+        _step_fingerprints[step_name] = (hasher.hexdigest(), sorted(set(re.findall(r"ctx\[\"(\w+)\"\]", inspect.getsource(step))) - {"doc", "doc_text"}))
+
+    fingerprint, settings_used = _step_fingerprints[step_name]
+    if not settings_used:
+        return fingerprint
+    return hashlib.sha1((fingerprint + repr([ctx[setting] for setting in settings_used])).encode("utf-8")).hexdigest()
+
+def open_result_cache(cache_file):
+    import sqlite3
+
+    if cache_file not in _result_cache_connections:
+        connection = sqlite3.connect(cache_file, timeout=60)
+        connection.execute("CREATE TABLE IF NOT EXISTS results (doc_hash TEXT, step TEXT, fingerprint TEXT, value TEXT, size INTEGER, last_used REAL, PRIMARY KEY (doc_hash, step, fingerprint))")
+        connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        connection.execute("CREATE TABLE IF NOT EXISTS stats (step TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)")
+        connection.commit()
+        _result_cache_connections[cache_file] = connection
+    return _result_cache_connections[cache_file]
+
+# Returns the cached results for a document - step name: (fingerprint, columns)
+def result_cache_get(cache_file, doc_hash):
+    import json
+
+    connection = open_result_cache(cache_file)
+    rows = connection.execute("SELECT step, fingerprint, value FROM results WHERE doc_hash = ?", (doc_hash,)).fetchall()
+    return {(step, fingerprint): json.loads(value) for step, fingerprint, value in rows}
+
+# Store the new results for a document, mark the cached results as used and update the hit statistics
+def result_cache_put(cache_file, doc_hash, new_results, used_results, hits, misses, max_size_mb=1024):
+    import json
+
+    connection = open_result_cache(cache_file)
+    now = time.time()
+    rows = []
+    for (step, fingerprint), columns in new_results.items():
+        value = json.dumps(columns, ensure_ascii=False, default=str)
+        rows.append((doc_hash, step, fingerprint, value, len(value), now))
+    connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", rows)
+    connection.executemany("UPDATE results SET last_used = ? WHERE doc_hash = ? AND step = ? AND fingerprint = ?",
+                           [(now, doc_hash, step, fingerprint) for step, fingerprint in used_results])
+    connection.executemany("INSERT INTO stats VALUES (?, ?, ?) ON CONFLICT(step) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses",
+                           [(step, hits.get(step, 0), misses.get(step, 0)) for step in set(hits) | set(misses)])
+
+    # Check the size for every 100 documents with new results, and remove the least recently used results when the cache is too large
+    if rows:
+        _result_cache_puts[cache_file] = _result_cache_puts.get(cache_file, 0) + 1
+        if _result_cache_puts[cache_file] % 100 == 1:
+            result_cache_evict(connection, max_size_mb)
+    connection.commit()
+
+def result_cache_evict(connection, max_size_mb):
+    total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+    max_size = max_size_mb * 1024 * 1024
+    if total_size <= max_size:
+        return 0
+    # Remove down to 90% of the limit, so the eviction does not run for every new document
+    removed = 0
+    for rowid, size in connection.execute("SELECT rowid, size FROM results ORDER BY last_used").fetchall():
+        if total_size <= 0.9 * max_size:
+            break
+        connection.execute("DELETE FROM results WHERE rowid = ?", (rowid,))
+        total_size -= size
+        removed += 1
+    return removed
+
+# Print the cache hit rates per step
+def print_cache_stats(cache_file):
+    connection = open_result_cache(cache_file)
+    entries, total_size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+    print(f"{entries} cached results, {total_size / (1024 * 1024):.1f} MB")
+    print(f"{'Step':<22}{'Hits':>10}{'Misses':>10}{'Hit rate':>10}")
+    for step, hits, misses in connection.execute("SELECT step, hits, misses FROM stats ORDER BY step"):
+        print(f"{step:<22}{hits:>10}{misses:>10}{100 * hits / max(hits + misses, 1):>9.1f}%")
+
+# This section stores the long text columns as references into a compressed text store instead of copying the text into every row.
+# A reference looks like "@3f2a9c81d0e4:1520-1873,2210-2391|Hjertet vejer 380 g og er af..." - the document id, the character spans
+# in the concatenated document text, and a short preview. Pieces of the column value are separated by "/" (the " / " separator used by the
+# extractors), and a piece that the extractor joined from several places in the text has several spans separated by ",".
+# The steps for the organ descriptions, COD tekst and Strip_text return the spans they took the text from ("_spans:<column>"). For the other columns,
+# each piece must be found exactly once, word for word, in the document text - so the span is where the extractor found it.
+# A value is only stored as a reference when the spans give the value exactly - other values are kept as they are.
+# The document texts are stored zlib-compressed in an SQLite file, and expand_text_reference returns the full text of a reference.
+
+# Columns that are stored as references when text references are used
+text_reference_columns = ["Hjertebeskrivelse", "Aortabeskrivelse", "Carotider_beskrivelse", "Lungebeskrivelse", "Leverbeskrivelse", "Nyrebeskrivelse",
+                          "Finde tekst", "Skumsvamp tekst", "Strip_text", "COD tekst", "Vaccine text", "TPS", "Kendte sygdomme"]
+
+# Number of characters of the text in the preview
+text_reference_preview = 40
+
+# Number of documents written to the text store between commits
+text_store_commit_interval = 200
+
+# Text store connections in this process - text store file: connection
+_text_store_connections = {}
+
+# Documents written to each text store since the last commit - text store file: count
+_text_store_pending = {}
+
+# Returns the span (start, end) of piece in text, or None if piece is not found exactly once in text
+def _text_span(text, piece):
+    start = text.find(piece)
+    if not piece or start < 0 or text.find(piece, start + 1) >= 0:
+        return None
+    return start, start + len(piece)
+
+# Returns the reference for a column value, or None if the value is not made of pieces of the document text (then the value is kept).
+# spans are the spans from the step - a list of pieces, each a list of (start, end) (None = each piece is looked up in the text).
+def text_reference(doc_id, text, value, spans=None):
+    if spans is None:
+        spans = []
+        for piece in value.split(" / "):
+            span = _text_span(text, piece)
+            if span is None:
+                return None
+            spans.append([span])
+    if " / ".join("".join(text[start:end] for start, end in piece) for piece in spans) != value:
+        return None
+
+    pieces = []
+    for piece in spans:
+        # Spans that follow each other are written as one span
+        merged = []
+        for start, end in piece:
+            if merged and merged[-1][1] == start:
+                merged[-1][1] = end
+            else:
+                merged.append([start, end])
+        pieces.append(",".join(f"{start}-{end}" for start, end in merged))
+    preview = value[:text_reference_preview].replace("|", " ")
+    return f"@{doc_id}:{'/'.join(pieces)}|{preview}"
+
+def open_text_store(text_store_file):
+    import sqlite3
+
+    if text_store_file not in _text_store_connections:
+        connection = sqlite3.connect(text_store_file, timeout=60)
+        connection.execute("CREATE TABLE IF NOT EXISTS texts (doc_id TEXT PRIMARY KEY, file_name TEXT, text BLOB)")
+        connection.commit()
+        _text_store_connections[text_store_file] = connection
+    return _text_store_connections[text_store_file]
+
+# Store a document text from a record - compressed_text is the "_text" entry (document id, file name, zlib-compressed text).
+# The texts are committed for every text_store_commit_interval documents and by text_store_commit.
+def text_store_put(text_store_file, compressed_text):
+    connection = open_text_store(text_store_file)
+    connection.execute("INSERT OR IGNORE INTO texts VALUES (?, ?, ?)", compressed_text)
+    _text_store_pending[text_store_file] = _text_store_pending.get(text_store_file, 0) + 1
+    if _text_store_pending[text_store_file] >= text_store_commit_interval:
+        text_store_commit(text_store_file)
+
+def text_store_commit(text_store_file):
+    if _text_store_pending.get(text_store_file):
+        open_text_store(text_store_file).commit()
+    _text_store_pending[text_store_file] = 0
+
+def text_store_get(text_store_file, doc_id):
+    import zlib
+
+    row = open_text_store(text_store_file).execute("SELECT text FROM texts WHERE doc_id = ?", (doc_id,)).fetchone()
+    if row is None:
+        raise KeyError(f"Document {doc_id} is not in {text_store_file}")
+    return zlib.decompress(row[0]).decode("utf-8")
+
+# Returns the full text of a column value - values that are not references are returned unchanged
+def expand_text_reference(value, text_store_file, texts=None):
+    match = re.match(r"@([0-9a-f]+):([\d,/-]*)\|", value) if isinstance(value, str) else None
+    if match is None:
+        return value
+    doc_id = match.group(1)
+    if texts is None:
+        texts = {}
+    if doc_id not in texts:
+        texts[doc_id] = text_store_get(text_store_file, doc_id)
+    text = texts[doc_id]
+
+    pieces = []
+    for piece in match.group(2).split("/"):
+        spans = [span.split("-") for span in piece.split(",") if span]
+        pieces.append("".join(text[int(start):int(end)] for start, end in spans))
+    return " / ".join(pieces)
+
+# Expand the references in a CSV file (from extract --text-store) and write the result to a new CSV file.
+# file_names: only expand and write the rows for these documents (None = all rows).
+def expand_csv(csv_filename, text_store_file, output_filename, file_names=None):
+    with open(csv_filename, "r", newline="", encoding="utf-16") as file:
+        reader = csv.DictReader(file)
+        fieldnames = reader.fieldnames
+        rows = [row for row in reader if file_names is None or row["File Name"] in file_names]
+
+    texts = {}
+    for row in rows:
+        for key in fieldnames:
+            row[key] = expand_text_reference(row[key], text_store_file, texts)
+
+    with open(output_filename, "w", newline="", encoding="utf-16") as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames, quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        writer.writerows(rows)
+    return len(rows)
+
+# Read one docx-file and run all extraction steps on it. Returns the data dictionary (one row in the output).
+# steps is a list of step names to run (None runs all steps).
+# cache_file is the result cache (None = no cache) - steps with a cached result for this document and step fingerprint are not run again,
+# and the document is not read at all if all steps are cached. cache_size_mb is the size limit of the cache.
+# text_store_file stores the text_reference_columns as references into the document text (None = the full text is kept). The document id is the
+# hash of the file content - if the text is already in the text store it is taken from there, otherwise the document is read and the compressed
+# text is added to the record as "_text" for the caller to write to the text store (see iter_records).
+# on_step is called with the name of each step before it is run, so the caller knows which step was running if the document fails or hangs.
+# batch=True leaves the batch_steps to finish_batch, which runs them on a number of documents at once - the record is not complete until then.
+# paragraph_cache_file is the persistent paragraph cache (see paragraph_result) - new results are written by save_paragraph_cache.
+def extract_document(file_path, keywords, organ_keywords, keywordCT, steps=None, cache_file=None, cache_size_mb=1024, text_store_file=None,
+                     paragraph_cache_file=None, on_step=None, batch=False):
+    import copy
+
+    filename = os.path.basename(file_path)
+    use_paragraph_cache_file(paragraph_cache_file)
+
+    ctx = {
+        "doc": None,
+        "doc_text": None,
+        "doc_text_lower": None,
+        "keywords": keywords,
+        "organ_keywords": organ_keywords,
+        "keywordCT": keywordCT,
+    }
+
+    # Look up the cached results for this document
+    cached = {}
+    if cache_file or text_store_file:
+        if on_step:
+            on_step("cache")
+        import hashlib
+        import io
+
+        with open(file_path, "rb") as file:
+            content = file.read()
+        doc_hash = hashlib.sha1(content).hexdigest()
+        if cache_file:
+            cached = result_cache_get(cache_file, doc_hash)
+        document_source = io.BytesIO(content)
+    else:
+        document_source = file_path
+
+    # Create a dictionary to store the data for this document
+    data = {"File Name": filename}
+    new_results = {}
+    used_results = []
+    hits = {}
+    misses = {}
+
+    # Read the document using the docx module and concatenate all paragraph texts into a single string - only when the first step has to run
+    def read_document():
+        if on_step:
+            on_step("load")
+        ctx["doc"] = load_document(document_source)
+        if on_step:
+            on_step("text")
+        ctx["doc_text"] = join_paragraphs(paragraph.text for paragraph in ctx["doc"].paragraphs)
+
+    for step_name, step in extraction_steps:
+        if steps is not None and step_name not in steps:
+            continue
+
+        if cache_file:
+            fingerprint = step_fingerprint(step_name, step, ctx)
+            if (step_name, fingerprint) in cached:
+                data.update(cached[(step_name, fingerprint)])
+                used_results.append((step_name, fingerprint))
+                hits[step_name] = 1
+                continue
+            misses[step_name] = 1
+
+        if ctx["doc"] is None:
+            read_document()
+
+        # The batch steps are run later by finish_batch - "_batch:<step name>" keeps the place of the columns in the record
+        if batch and step_name in batch_steps:
+            data[f"_batch:{step_name}"] = fingerprint if cache_file else None
+            data["_batch"] = (ctx["doc_text"], cache_file, doc_hash if cache_file else None, cache_size_mb)
+            continue
+
+        # A step that cannot match this document is not run (see prefilter_steps)
+        if step_name in prefilter_steps:
+            if on_step:
+                on_step("prefilter")
+            if ctx["doc_text_lower"] is None:
+                ctx["doc_text_lower"] = ctx["doc_text"].lower()
+            literals, empty_columns = prefilter_steps[step_name]
+            if not any(literal in ctx["doc_text_lower"] for literal in literals):
+                columns = copy.deepcopy(empty_columns)
+                data.update(columns)
+                if cache_file:
+                    new_results[(step_name, fingerprint)] = columns
+                continue
+
+        if on_step:
+            on_step(step_name)
+        columns = step(ctx)
+        data.update(columns)
+        if cache_file:
+            new_results[(step_name, fingerprint)] = columns
+
+    if cache_file:
+        result_cache_put(cache_file, doc_hash, new_results, used_results, hits, misses, cache_size_mb)
+
+    # The spans from the steps are only used for the text references
+    spans = {key[len("_spans:"):]: data.pop(key) for key in [key for key in data if key.startswith("_spans:")]}
+
+    # Replace the long text columns by references into the document text - the cached results keep the full text
+    if text_store_file and any(data.get(column) for column in text_reference_columns):
+        import zlib
+
+        if on_step:
+            on_step("text_references")
+        doc_id = doc_hash[:12]
+        doc_text = ctx["doc_text"]
+        if doc_text is None:
+            # All steps were cached - the text is taken from the text store if an earlier run stored it
+            try:
+                doc_text = text_store_get(text_store_file, doc_id)
+            except KeyError:
+                read_document()
+                doc_text = ctx["doc_text"]
+                data["_text"] = (doc_id, filename, zlib.compress(doc_text.encode("utf-8")))
+        else:
+            data["_text"] = (doc_id, filename, zlib.compress(doc_text.encode("utf-8")))
+        for column in text_reference_columns:
+            if isinstance(data.get(column), str) and data[column]:
+                reference = text_reference(doc_id, doc_text, data[column], spans.get(column))
+                if reference is not None:
+                    data[column] = reference
+
+    return data
+
+# Run the batch steps that extract_document(..., batch=True) left in the records, on all the records at once.
+# Returns a dictionary of record number: (step name, reason) for the records where a step failed - the other records are complete.
+def finish_batch(records):
+    numbers = [number for number, data in enumerate(records) if "_batch" in data]
+    columns = {number: {} for number in numbers}
+    failed = {}
+
+    for step_name, (patterns, make_columns) in batch_steps.items():
+        step_numbers = [number for number in numbers if f"_batch:{step_name}" in records[number]]
+        if not step_numbers:
+            continue
+        try:
+            step_matches = batch_first_matches(patterns, [records[number]["_batch"][0] for number in step_numbers])
+        except Exception:
+            # Run the step on one document at a time, so only the document that fails is quarantined
+            step_matches = [None] * len(step_numbers)
+        for number, matches in zip(step_numbers, step_matches):
+            try:
+                if matches is None:
+                    matches = first_matches(patterns, records[number]["_batch"][0])
+                columns[number][step_name] = make_columns(matches)
+            except Exception as e:
+                failed.setdefault(number, (step_name, f"{type(e).__name__}: {e}"))
+
+    # Put the columns in the place of the steps and store them in the result cache
+    for number in numbers:
+        data = records[number]
+        doc_text, cache_file, doc_hash, cache_size_mb = data.pop("_batch")
+        if number in failed:
+            continue
+        new_results = {}
+        completed = {}
+        for key, value in data.items():
+            if key.startswith("_batch:"):
+                step_name = key[len("_batch:"):]
+                completed.update(columns[number][step_name])
+                new_results[(step_name, value)] = columns[number][step_name]
+            else:
+                completed[key] = value
+        records[number] = completed
+        if cache_file:
+            result_cache_put(cache_file, doc_hash, new_results, [], {}, {}, cache_size_mb)
+    return failed
+
+
+# This section runs the documents in worker processes, which are also used as watchdogs.
+# A document that takes longer than the timeout, uses more memory than the memory limit or crashes the worker is put in the quarantine list
+# together with the step that was running, and the worker is replaced by a new one. The remaining documents continue in the other workers.
+
+quarantine_fields = ["File Path", "Step", "Reason", "Time"]
+
+# Reads the quarantine list from a previous run - returns a dictionary of file path: quarantine entry
+def read_quarantine(quarantine_file):
+    if not quarantine_file or not os.path.exists(quarantine_file):
+        return {}
+    with open(quarantine_file, "r", newline="", encoding="utf-8") as file:
+        return {row["File Path"]: row for row in csv.DictReader(file)}
+
+def write_quarantine(quarantine, quarantine_file):
+    with open(quarantine_file, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=quarantine_fields)
+        writer.writeheader()
+        writer.writerows(quarantine.values())
+
+def _quarantine_entry(file_path, step, reason):
+    return {"File Path": file_path, "Step": step, "Reason": reason, "Time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+# Maximum number of different extractor messages that are counted - the rest are counted as "(other messages)"
+extractor_message_limit = 1000
+
+# Stands in for stdout while the extractors run. The extractors print messages such as "Error processing end sentences" for many documents -
+# instead of printing them line by line, the lines are counted (message: count), and the progress reporter shows the most frequent ones.
+class ExtractorOutput:
+    def __init__(self, counts=None):
+        self.counts = {} if counts is None else counts
+        self.partial = ""
+
+    def write(self, text):
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line not in self.counts and len(self.counts) >= extractor_message_limit:
+                line = "(other messages)"
+            self.counts[line] = self.counts.get(line, 0) + 1
+        return len(text)
+
+    def flush(self):
+        pass
+
+# Add the extractor message counts from one process to the totals
+def add_extractor_messages(totals, counts):
+    for message, count in counts.items():
+        totals[message] = totals.get(message, 0) + count
+
+# Worker process - receives tasks (lists of (index, file path)) through the pipe and sends back ("ok", index, data) or ("error", index, step, reason)
+# for each document, and ("done", paragraph cache statistics, extractor message counts) when the task is finished. The current step, document index
+# and start time are kept in shared memory, so the main process can see what the worker was doing if it hangs or crashes.
+# The output of the extractors is counted (see ExtractorOutput) - quiet=True discards it.
+def _watchdog_worker(conn, status, settings, mem_limit_mb, quiet=False):
+    import sys
+    from collections import deque
+
+    current_step, current_index, current_start = status
+    sys.stdout = open(os.devnull, "w") if quiet else ExtractorOutput()
+
+    if mem_limit_mb:
+        # The resource module only exists on Unix - on Windows the main process checks the memory use of the worker instead (requires psutil)
+        try:
+            import resource
+            limit = int(mem_limit_mb * 1024 * 1024)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError):
+            pass
+
+    def on_step(step_name):
+        current_step.value = step_name.encode("utf-8")[:63]
+
+    try:
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            if isinstance(task, tuple):
+                # A steal request that arrived after the task was finished - the main process stops waiting for the answer when it gets "done"
+                continue
+            task = deque(task)
+            batch = len(task) > 1
+            finished = []  # (index, data) for the documents that wait for the batch steps
+            while task:
+                # The main process can take back documents that are not started yet and give them to an idle worker.
+                # They are taken from the end of the task, and the worker continues with the rest.
+                if conn.poll():
+                    message = conn.recv()
+                    if message is None:
+                        return
+                    conn.send(("stolen", [task.pop() for _ in range(min(message[1], len(task) - 1))]))
+                index, file_path = task.popleft()
+                current_index.value = index
+                current_start.value = time.time()
+                try:
+                    finished.append((index, extract_document(file_path, *settings, on_step=on_step, batch=batch)))
+                except MemoryError:
+                    conn.send(("error", index, current_step.value.decode("utf-8"), "MemoryError"))
+                except Exception as e:
+                    conn.send(("error", index, current_step.value.decode("utf-8"), f"{type(e).__name__}: {e}"))
+
+            # Run the batch steps on all documents in the task - the status shows the first document, but if the worker is stopped in this step,
+            # the main process runs all the unfinished documents of the task again one at a time (without the batch step) instead of quarantining it
+            if finished:
+                current_index.value = finished[0][0]
+                current_start.value = time.time()
+                on_step("batch")
+                records = [data for index, data in finished]
+                failed = finish_batch(records)
+                for number, (index, data) in enumerate(finished):
+                    if number in failed:
+                        conn.send(("error", index, *failed[number]))
+                    else:
+                        conn.send(("ok", index, records[number]))
+            current_index.value = -1
+            conn.send(("done", _paragraph_cache_stats, getattr(sys.stdout, "counts", {})))
+    finally:
+        # Write the new paragraph cache results when the worker is stopped
+        save_paragraph_cache()
+
+def _start_watchdog_worker(settings, mem_limit_mb, quiet=False):
+    import multiprocessing
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    status = (multiprocessing.Array("c", 64), multiprocessing.Value("q", -1), multiprocessing.Value("d", 0.0))
+    worker = multiprocessing.Process(target=_watchdog_worker, args=(child_conn, status, settings, mem_limit_mb, quiet), daemon=True)
+    worker.start()
+    child_conn.close()
+    return {"process": worker, "conn": parent_conn, "status": status, "task": None, "stealing": False}
+
+def _stop_watchdog_worker(slot, kill=False):
+    worker = slot["process"]
+    if kill:
+        worker.kill()
+    else:
+        try:
+            slot["conn"].send(None)
+        except (OSError, EOFError):
+            pass
+    worker.join(5)
+    if worker.is_alive():
+        worker.kill()
+        worker.join()
+    slot["conn"].close()
+
+# Returns the memory use (MB) of a process, or None if psutil is not installed
+def _process_memory_mb(pid):
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / (1024 * 1024)
+    except Exception:
+        return None
+
+# Process the files in "workers" worker processes. Yields the data dictionary for each document that succeeds.
+# ordered=True yields the documents in the order of file_paths, ordered=False yields them as soon as they are ready.
+# Failing documents are added to the quarantine dictionary (file path: quarantine entry) and skipped.
+# file_paths can be any iterable (e.g. a generator) - it is read in windows of "window" files when the workers are ready for more work.
+# The documents in a window are given out largest first, so the long reports do not end up at the end of the run. Files smaller than
+# batch_bytes are sent together in tasks of up to batch_bytes (and at most batch_files files), so the many short supplementary reports do not
+# wait for the main process between each document. A worker that is idle when there is no more work takes half of the remaining documents
+# from the task of another worker.
+# sizes is an optional dictionary of file path: file size (e.g. from crawl_docx_files) - other files are looked up with os.path.getsize.
+# Used sizes are removed from the dictionary.
+# max_buffer_mb limits the memory used by records that wait for an earlier document when ordered=True - while the limit is exceeded, only the
+# earliest unfinished document is given to a worker.
+# state: optional dictionary that is updated with the number of files queued and records waiting, and the number of files, bytes and errors done,
+# for progress reports, and with the extractor message counts of the workers (see ExtractorOutput). quiet=True discards the output of the extractors.
+def iter_watchdog(file_paths, settings, timeout=None, mem_limit_mb=None, quarantine=None, workers=1, ordered=True, poll_interval=0.5,
+                  sizes=None, window=1000, batch_bytes=256 * 1024, batch_files=32, max_buffer_mb=None, state=None, quiet=False):
+    import itertools
+    from collections import deque
+    from multiprocessing.connection import wait
+
+    if quarantine is None:
+        quarantine = {}
+    if sizes is None:
+        sizes = {}
+    if state is None:
+        state = {}
+    state.update({"files_done": 0, "bytes_done": 0, "errors": 0, "extractor_messages": {}})
+
+    paths = {}  # index: file path for documents that are not finished
+    results = {}  # index: data (or None if the document failed) - only used when ordered=True
+    waiting_bytes = 0  # memory use of the records in results
+    paragraph_cache_stats = {}  # worker process id: paragraph cache statistics
+    extractor_messages = {}  # worker process id: extractor message counts
+    finished = []  # finished documents - only used when ordered=False
+    next_index = 0  # next index to yield when ordered=True
+    requeued = deque()  # tasks with documents from a worker that was replaced, or taken from the task of another worker
+    pending = []  # (size, -index, file path) for the documents in the current window that are not given out yet - the largest is last
+    index_sizes = {}  # index: file size, for the progress report
+    source = enumerate(file_paths)
+    source_empty = False
+
+    def file_size(file_path):
+        if file_path in sizes:
+            return sizes.pop(file_path)
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+
+    def next_task():
+        nonlocal source_empty
+        if requeued:
+            return requeued.popleft()
+
+        # Read the next window when all documents in the current window are given out
+        if not pending and not source_empty:
+            for index, file_path in itertools.islice(source, window):
+                paths[index] = file_path
+                index_sizes[index] = file_size(file_path)
+                pending.append((index_sizes[index], -index, file_path))
+            if len(pending) < window:
+                source_empty = True
+            pending.sort()
+        if not pending:
+            return None
+
+        # When too many records wait for an earlier document, only the earliest document is given out, so the waiting records can be yielded
+        if max_buffer_mb is not None and waiting_bytes > max_buffer_mb * 1024 * 1024:
+            for number, (size, index, file_path) in enumerate(pending):
+                if -index == next_index:
+                    del pending[number]
+                    return [(next_index, file_path)]
+            return None
+
+        # The largest document first - if it is small, the next largest documents are added to the task up to batch_bytes
+        size, index, file_path = pending.pop()
+        task = [(-index, file_path)]
+        while pending and len(task) < batch_files and size + pending[-1][0] <= batch_bytes:
+            next_size, index, file_path = pending.pop()
+            size += next_size
+            task.append((-index, file_path))
+        return task
+
+    # Ask the worker with the most documents left in its task to give half of them back, for an idle worker
+    def steal(slots):
+        if any(slot["stealing"] for slot in slots):
+            return
+        busy = [slot for slot in slots if slot["task"] is not None and len(slot["task"]) > 1]
+        if not busy:
+            return
+        victim = max(busy, key=lambda slot: len(slot["task"]))
+        try:
+            victim["conn"].send(("steal", len(victim["task"]) // 2))
+            victim["stealing"] = True
+        except (OSError, EOFError):
+            pass
+
+    def finish(index, data):
+        nonlocal waiting_bytes
+        paths.pop(index, None)
+        state["files_done"] += 1
+        state["bytes_done"] += index_sizes.pop(index, 0)
+        if ordered:
+            results[index] = data
+            if data is not None:
+                waiting_bytes += record_size(data)
+        elif data is not None:
+            finished.append(data)
+
+    def fail(index, step, reason):
+        file_path = paths[index]
+        print(f"Quarantined {os.path.basename(file_path)} in step {step}: {reason}")
+        quarantine[file_path] = _quarantine_entry(file_path, step, reason)
+        state["errors"] += 1
+        finish(index, None)
+
+    def handle(slot, message):
+        if message[0] == "ok":
+            slot["task"].discard(message[1])
+            quarantine.pop(paths[message[1]], None)
+            finish(message[1], message[2])
+        elif message[0] == "error":
+            slot["task"].discard(message[1])
+            fail(message[1], message[2], message[3])
+        elif message[0] == "stolen":
+            slot["stealing"] = False
+            if message[1]:
+                for index, file_path in message[1]:
+                    slot["task"].discard(index)
+                requeued.append(sorted(message[1]))
+        else:
+            slot["task"] = None
+            slot["stealing"] = False
+            paragraph_cache_stats[slot["process"].pid] = message[1]
+            extractor_messages[slot["process"].pid] = message[2]
+
+    slots = [_start_watchdog_worker(settings, mem_limit_mb, quiet) for _ in range(max(workers, 1))]
+
+    try:
+        while True:
+            # Give work to the idle workers - when there is no more work, an idle worker takes work from another worker
+            for slot in slots:
+                if slot["task"] is None:
+                    task = next_task()
+                    if task is None:
+                        steal(slots)
+                        break
+                    slot["task"] = {index for index, file_path in task}
+                    slot["conn"].send(task)
+
+            busy = [slot for slot in slots if slot["task"] is not None]
+            if not busy:
+                break
+
+            for conn in wait([slot["conn"] for slot in busy], timeout=poll_interval):
+                slot = next(slot for slot in busy if slot["conn"] is conn)
+                try:
+                    handle(slot, conn.recv())
+                except (EOFError, OSError):
+                    pass
+
+            # Check the busy workers for crashes, timeouts and memory use
+            for position, slot in enumerate(slots):
+                if slot["task"] is None:
+                    continue
+                current_step, current_index, current_start = slot["status"]
+                reason = None
+                if not slot["process"].is_alive():
+                    reason = f"Worker crashed (exit code {slot['process'].exitcode})"
+                elif timeout and current_index.value >= 0 and time.time() - current_start.value > timeout:
+                    reason = f"Timeout after {timeout} s"
+                elif mem_limit_mb:
+                    memory_mb = _process_memory_mb(slot["process"].pid)
+                    if memory_mb is not None and memory_mb > mem_limit_mb:
+                        reason = f"Memory limit exceeded ({memory_mb:.0f} MB)"
+                if reason is None:
+                    continue
+
+                # Collect the results the worker sent before it stopped, then quarantine the document it was working on
+                try:
+                    while slot["task"] is not None and slot["conn"].poll():
+                        handle(slot, slot["conn"].recv())
+                except (EOFError, OSError):
+                    pass
+                if slot["task"] is None:
+                    continue
+                # In the batch step, the document that caused the problem is not known - the documents are run again one at a time, so a
+                # document that still fails is quarantined with the step it fails in
+                index = current_index.value
+                if index in slot["task"] and current_step.value.decode("utf-8") != "batch":
+                    slot["task"].discard(index)
+                    fail(index, current_step.value.decode("utf-8"), reason)
+
+                # The rest of the task is given to other workers, and the worker is replaced by a new one
+                requeued.extend([(index, paths[index])] for index in sorted(slot["task"]))
+                _stop_watchdog_worker(slot, kill=True)
+                slots[position] = _start_watchdog_worker(settings, mem_limit_mb, quiet)
+
+            state.update({"queued": len(pending), "waiting": len(results), "waiting_bytes": waiting_bytes})
+            state["paragraph_cache"] = {}
+            for stats in paragraph_cache_stats.values():
+                add_paragraph_cache_stats(state["paragraph_cache"], stats)
+            state["extractor_messages"] = {}
+            for counts in extractor_messages.values():
+                add_extractor_messages(state["extractor_messages"], counts)
+
+            # Yield the finished documents
+            if ordered:
+                while next_index in results:
+                    data = results.pop(next_index)
+                    next_index += 1
+                    if data is not None:
+                        waiting_bytes -= record_size(data)
+                        yield data
+            else:
+                while finished:
+                    yield finished.pop(0)
+    finally:
+        for slot in slots:
+            _stop_watchdog_worker(slot)
+
+# Yields the file paths that are not in the quarantine list - the skipped paths are added to the "skipped" list
+def skip_quarantined(file_paths, quarantine, skipped=None):
+    for file_path in file_paths:
+        if file_path in quarantine:
+            if skipped is not None:
+                skipped.append(file_path)
+            continue
+        yield file_path
+
+# Serial processing in the main process - failing documents are quarantined as in iter_watchdog, but there is no timeout or memory limit
+# The batch steps are left to finish_batch, which runs them on the waiting documents at once when batch_size documents are waiting or the first
+# of them has waited batch_seconds - so records still come out steadily. A document without batch steps to run (e.g. all steps cached) is yielded
+# at once if no earlier document is waiting. The records are yielded in the order of file_paths.
+def iter_serial(file_paths, settings, quarantine, batch_size=64, batch_seconds=1.0, state=None, sizes=None, quiet=False):
+    import contextlib
+
+    if state is None:
+        state = {}
+    if sizes is None:
+        sizes = {}
+    state.update({"files_done": 0, "bytes_done": 0, "errors": 0, "paragraph_cache": _paragraph_cache_stats, "extractor_messages": {}})
+
+    def file_size(file_path):
+        if file_path in sizes:
+            return sizes.pop(file_path)
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+
+    # The output of the extractors is counted (see ExtractorOutput) - quiet=True discards it
+    devnull = open(os.devnull, "w") if quiet else None
+    messages = ExtractorOutput(state["extractor_messages"])
+
+    def output():
+        return contextlib.redirect_stdout(devnull if quiet else messages)
+
+    # Run the batch steps on the waiting documents - returns the records that succeed, in order
+    def finish_waiting(waiting):
+        records = [data for file_path, data in waiting]
+        with output():
+            failed = finish_batch(records)
+        finished = []
+        for number, (file_path, data) in enumerate(waiting):
+            if number in failed:
+                step_name, reason = failed[number]
+                print(f"Error processing {os.path.basename(file_path)}: {reason}")
+                quarantine[file_path] = _quarantine_entry(file_path, step_name, reason)
+                state["errors"] += 1
+                continue
+            quarantine.pop(file_path, None)
+            finished.append(records[number])
+        return finished
+
+    waiting = []  # (file path, record) of the documents waiting for the batch steps
+    waiting_since = None
+    try:
+        for file_path in file_paths:
+            current_step = ["load"]
+
+            def on_step(step_name):
+                current_step[0] = step_name
+
+            try:
+                with output():
+                    data = extract_document(file_path, *settings, on_step=on_step, batch=True)
+            except Exception as e:
+                print(f"Error processing {os.path.basename(file_path)}: {e}")
+                quarantine[file_path] = _quarantine_entry(file_path, current_step[0], f"{type(e).__name__}: {e}")
+                state["errors"] += 1
+                data = None
+            state["files_done"] += 1
+            state["bytes_done"] += file_size(file_path)
+
+            if data is not None:
+                if not waiting and "_batch" not in data:
+                    quarantine.pop(file_path, None)
+                    yield data
+                else:
+                    if not waiting:
+                        waiting_since = time.time()
+                    waiting.append((file_path, data))
+
+            if waiting and (len(waiting) >= batch_size or time.time() - waiting_since >= batch_seconds):
+                yield from finish_waiting(waiting)
+                waiting = []
+
+        if waiting:
+            yield from finish_waiting(waiting)
+    finally:
+        # Write the new paragraph cache results, so the next run can use them
+        save_paragraph_cache()
+        if devnull is not None:
+            devnull.close()
+
+# Generator that yields one extraction record (the data dictionary) per document as soon as it is ready.
+# source is a folder (all docx-files in it and its subfolders are processed) or an iterable of file paths.
+# workers=0 processes the documents in this process, workers>0 in that number of worker processes - ordered=False then yields the records
+# as they are finished instead of in the order of the files.
+# timeout (seconds) and mem_limit_mb run each document under the watchdog (in a worker process). Failing documents are written to quarantine_file.
+# quarantine_policy decides what to do with documents that are in the quarantine list from a previous run: "skip" them or "retry" them.
+# steps is a list of extraction step names to run (None runs all steps).
+# cache_file is the result cache file (None = no cache), cache_size_mb its size limit.
+# sizes is an optional dictionary of file path: file size, used by the workers to process the largest documents first (see iter_watchdog).
+# text_store_file: store the long text columns as references into this text store (see text_reference) instead of the full text.
+# max_buffer_mb and state are passed to iter_watchdog.
+# paragraph_cache_file: store the paragraph cache results in this file for the next run (see paragraph_result).
+# The output of the extractors is counted and shown by the progress reporter (see ExtractorOutput) - quiet=True discards it.
+def iter_records(source, keywords=None, organ_keywords=None, keywordCT=None, workers=0, ordered=True, timeout=None, mem_limit_mb=None,
+                 quarantine_file="quarantine.csv", quarantine_policy="skip", steps=None, cache_file=None, cache_size_mb=1024, sizes=None,
+                 text_store_file=None, max_buffer_mb=None, state=None, paragraph_cache_file=None, quiet=False):
+    settings = (
+        default_keywords if keywords is None else keywords,
+        default_organ_keywords if organ_keywords is None else organ_keywords,
+        default_keywordCT if keywordCT is None else keywordCT,
+        steps,
+        cache_file,
+        cache_size_mb,
+        text_store_file,
+        paragraph_cache_file,
+    )
+
+    if isinstance(source, str):
+        file_paths = find_docx_files(source)
+    else:
+        file_paths = source
+
+    # Skip documents that were quarantined in a previous run, unless they should be retried
+    quarantine = read_quarantine(quarantine_file)
+    if quarantine_policy == "skip" and quarantine:
+        file_paths = skip_quarantined(file_paths, dict(quarantine))
 
-    # List to store all paths for pdf-files
-    pdf_files = []
+    if state is None:
+        state = {}
+
+    if workers or timeout or mem_limit_mb:
+        records = iter_watchdog(file_paths, settings, timeout, mem_limit_mb, quarantine, workers=max(workers, 1), ordered=ordered, sizes=sizes,
+                                max_buffer_mb=max_buffer_mb, state=state, quiet=quiet)
+    else:
+        records = iter_serial(file_paths, settings, quarantine, state=state, sizes=sizes, quiet=quiet)
+
+    try:
+        for data in records:
+            # The document text is written to the text store here, so only one process writes to it
+            if "_text" in data:
+                text_store_put(text_store_file, data.pop("_text"))
+            yield data
+    finally:
+        records.close()
+        if text_store_file:
+            text_store_commit(text_store_file)
+        # Write the quarantine list, so the next run can skip or retry the failing documents
+        if quarantine_file and (quarantine or os.path.exists(quarantine_file)):
+            write_quarantine(quarantine, quarantine_file)
+            print("Quarantined files: " + str(len(quarantine)))
+
+# Loop through all files in the specified folder and subfolders (using os.walk) and return the paths of all docx-files
+def find_docx_files(folder_path):
+    docx_files = []
 
-    # Loop through all files in the specified folder and subfolders (using os.walk)
     for root, dirs, files in os.walk(folder_path):
         for file in files:
             if file.endswith(".docx"):
                 docx_files.append(os.path.join(root, file))
-                start_time = time.time()
             #elif file.endswith(".pdf"):
             #    pdf_files.append(os.path.join(root, file))
-            #    start_time = time.time()
-
-    # Total number of docx-files an pdf-files
-    total_files = len(docx_files) + len(pdf_files)
-    print("The total number of files is: " + str(total_files))
-    print("The total number of word-files is: " + str(len(docx_files)))
-    print("The total number of pdf-files is: " + str(len(pdf_files)))
-    time.sleep(2)
-    
-    # Loop through all docx-files
-    for file_path in docx_files:
-        filename = os.path.basename(file_path)
 
-        # Read the document using the docx module
+    return docx_files
+
+# Crawl the folder and its subfolders with a pool of threads - each thread lists one folder at a time with os.scandir, so the many slow
+# folder listings on the network share run concurrently. The paths of the docx-files are yielded as soon as they are found.
+# The listing is stored in cache_file together with the modification time of each folder, so later runs only list the folders that changed
+# (a folder's modification time changes when files are added, removed or renamed in it).
+# sizes: optional dictionary that is filled with file path: file size (from the scandir entries).
+# state: optional dictionary that is updated with the number of files (and bytes) found and folders listed, and an estimate of the total number of files.
+def crawl_docx_files(folder_path, threads=8, cache_file=None, sizes=None, state=None):
+    import json
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
         try:
-            start_time = time.time()
-            doc = Document(file_path)
-        except Exception as e:
-            print(f"Error processing {filename}: {e}")
-            continue
+            with open(cache_file, "r", encoding="utf-8") as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            cache = {}
+    new_cache = {}
+    if state is None:
+        state = {}
+    state.update({"files": 0, "bytes": 0, "folders_listed": 0, "folders_cached": 0, "folders_pending": 1, "estimated_total": None, "done": False})
+
+    # List one folder - returns the folder, its modification time, the docx-files (name, size) and the subfolders
+    def list_folder(folder):
+        mtime = os.stat(folder).st_mtime
+        cached = cache.get(folder)
+        if cached is not None and cached["mtime"] == mtime:
+            return folder, mtime, cached["files"], cached["folders"], True
+        files = []
+        folders = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    folders.append(entry.name)
+                elif entry.name.endswith(".docx"):
+                    files.append((entry.name, entry.stat().st_size))
+        return folder, mtime, files, folders, False
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        pending = {executor.submit(list_folder, folder_path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    folder, mtime, files, folders, from_cache = future.result()
+                except OSError as e:
+                    print(f"Error listing folder: {e}")
+                    continue
+                new_cache[folder] = {"mtime": mtime, "files": files, "folders": folders}
+                for name in folders:
+                    pending.add(executor.submit(list_folder, os.path.join(folder, name)))
+
+                state["folders_listed" if not from_cache else "folders_cached"] += 1
+                state["files"] += len(files)
+                state["bytes"] += sum(size for name, size in files)
+                state["folders_pending"] = len(pending)
+                folders_done = state["folders_listed"] + state["folders_cached"]
+                # Estimate of the total number of files - the average number of files per folder so far times the number of folders
+                state["estimated_total"] = round(state["files"] + len(pending) * state["files"] / folders_done)
+
+                for name, size in files:
+                    file_path = os.path.join(folder, name)
+                    if sizes is not None:
+                        sizes[file_path] = size
+                    yield file_path
+
+        state["estimated_total"] = state["files"]
+        state["done"] = True
+
+        if cache_file:
+            with open(cache_file, "w", encoding="utf-8") as file:
+                json.dump(new_cache, file, ensure_ascii=False)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Approximate memory use (bytes) of a record, including the lists, dictionaries and tuples in it (e.g. the lesion lists)
+def record_size(data):
+    import sys
+
+    size = 0
+    values = [data]
+    while values:
+        value = values.pop()
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            values += value.keys()
+            values += value.values()
+        elif isinstance(value, (list, tuple, set)):
+            values += value
+    return size
+
+# The records collected by process_documents when it has a memory budget. The records are kept in memory up to budget_mb, the rest are written
+# to a spill file (one JSON record per line) and read back when they are needed, so the memory use does not grow with the number of documents.
+# The records can be read in order (for data in records) or by position (records[5], records[-1]), as from a list. close() removes the spill file.
+class RecordSpill:
+    def __init__(self, budget_mb=None, spill_file=None):
+        self.records = []
+        self.memory_bytes = 0
+        self.budget_bytes = None if budget_mb is None else budget_mb * 1024 * 1024
+        self.spill_file = spill_file
+        self.file = None
+        self.offsets = []  # position in the spill file of each spilled record
+
+    def __len__(self):
+        return len(self.records) + len(self.offsets)
+
+    # Keep no more records in memory - e.g. when the process uses more memory than allowed
+    def stop_memory(self):
+        self.budget_bytes = self.memory_bytes
+
+    def append(self, data):
+        import json
+
+        size = record_size(data)
+        if self.file is None and (self.budget_bytes is None or self.memory_bytes + size <= self.budget_bytes):
+            self.records.append(data)
+            self.memory_bytes += size
+            return
+
+        if self.file is None:
+            if self.spill_file is None:
+                import tempfile
+                handle, self.spill_file = tempfile.mkstemp(prefix="records_", suffix=".jsonl")
+                os.close(handle)
+            self.file = open(self.spill_file, "w+b")
+        self.file.seek(0, os.SEEK_END)
+        self.offsets.append(self.file.tell())
+        self.file.write(json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    def __getitem__(self, position):
+        import json
+
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("record position out of range")
+        if position < len(self.records):
+            return self.records[position]
+        self.file.seek(self.offsets[position - len(self.records)])
+        return json.loads(self.file.readline())
+
+    def __iter__(self):
+        import json
+
+        yield from self.records
+        if self.file is not None:
+            self.file.flush()
+            with open(self.spill_file, "rb") as file:
+                for line in file:
+                    yield json.loads(line)
+
+    # Remove the spill file
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.spill_file)
+
+# This section is the aggregation stage. The records are added to the aggregates as they come from the extractor, so the summaries
+# (e.g. COD flags by year and sex, organ weights by age group, putrefaction levels) are computed without loading the CSV file.
+# For each group (year, sex, age group) and for all records, the aggregates count the records, the True flags and the (non-empty) values
+# of the category columns, and keep the count, sum, min, max and a quantile sketch of the value columns. Two aggregates are merged by adding
+# the counts and sketches, so the summaries of several runs (e.g. one per folder) can be merged to the summary of all documents.
+
+# Default columns - the organ weight columns are the lowercase weight keywords
+aggregate_flag_columns = list(COD_regex_dict) + list(findeomst_regex_dict) + ["Autoerot"]
+aggregate_category_columns = ["Putre_level", "Prim_status", "Age unit"]
+aggregate_value_columns = ["Højde", "Vægt", "højre hjertekammer", "venstre hjertekammer", "hjerteskille"]
+
+# The quantiles in the summary file, and the relative accuracy of the quantile sketch
+aggregate_quantiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+aggregate_relative_accuracy = 0.01
+
+# Quantile sketch with logarithmic buckets: a positive value x is counted in bucket ceil(log(x) / log(gamma)), gamma = (1 + a) / (1 - a),
+# so every quantile is estimated within the relative accuracy a (1% by default) and two sketches are merged by adding the bucket counts.
+# Values <= 0 are counted separately and estimated as 0.
+class QuantileSketch:
+    def __init__(self, relative_accuracy=aggregate_relative_accuracy):
+        import math
+
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}  # bucket index: count
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        import math
+
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if value <= 0:
+            self.zeros += 1
+        else:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(f"Cannot merge quantile sketches with relative accuracy {self.relative_accuracy} and {other.relative_accuracy}")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    # The value at quantile q (0-1) - the middle of the bucket with the value of rank q * (count - 1), limited to min and max
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "quantiles": {f"p{round(q * 100):02d}": self.quantile(q) for q in aggregate_quantiles},
+            "sum": self.sum,
+            "zeros": self.zeros,
+            "buckets": {str(index): count for index, count in sorted(self.buckets.items())},
+        }
 
-        # Concatenate all paragraph texts into a single string
-        doc_text = " ".join([paragraph.text.replace("\n", " ").replace("\r", " ") for paragraph in doc.paragraphs])
-        print(len(doc_text))
+    @classmethod
+    def from_dict(cls, data, relative_accuracy=aggregate_relative_accuracy):
+        sketch = cls(relative_accuracy)
+        sketch.buckets = {int(index): count for index, count in data["buckets"].items()}
+        sketch.zeros = data["zeros"]
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        sketch.min = data["min"]
+        sketch.max = data["max"]
+        return sketch
+
+# Year of the autopsy date - the dates in CSV files from earlier runs (dd-mm-yyyy, dd-mm-yy) are normalized first
+def record_year(data):
+    match = re.match(r"(\d{4})-\d{2}-\d{2}$", normalize_date(str(data.get("Autopsy Date") or "")))
+    return match.group(1) if match else ""
+
+# A number from a record value (e.g. "1800", "10,5" or 420), or None
+def record_number(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip().replace(",", "."))
+    except ValueError:
+        return None
+
+# Age group of the record: 10-year groups for ages in years (and months), "<1" for the other age units (newborn, weeks etc.)
+def record_age_group(data):
+    age = record_number(data.get("Age"))
+    unit = data.get("Age unit")
+    if age is None or not unit:
+        return ""
+    if unit == "mon":
+        age = age / 12
+    elif unit != "yrs":
+        return "<1"
+    if age < 1:
+        return "<1"
+    decade = int(age // 10) * 10
+    return f"{decade}-{decade + 9}"
+
+# The groups the records are counted in - each function returns the group value of a record
+aggregate_groups = OrderedDict([
+    ("year", record_year),
+    ("sex", lambda data: data.get("Sex") or ""),
+    ("age_group", record_age_group),
+])
+
+# The aggregates of the records in all groups. Use add(data) for each record, merge(other) to add the aggregates of another run,
+# and write(filename) / Aggregates.read(filename) for the summary file (JSON).
+class Aggregates:
+    def __init__(self, flag_columns=None, category_columns=None, value_columns=None, relative_accuracy=aggregate_relative_accuracy):
+        self.flag_columns = list(aggregate_flag_columns if flag_columns is None else flag_columns)
+        self.category_columns = list(aggregate_category_columns if category_columns is None else category_columns)
+        self.value_columns = list(aggregate_value_columns + [keyword.lower() for keyword in default_keywords] if value_columns is None else value_columns)
+        self.relative_accuracy = relative_accuracy
+        self.groups = {}  # (year, sex, age group): aggregate of the group
+        self.total = self.new_group()
+
+    def new_group(self):
+        return {
+            "count": 0,
+            "flags": {column: 0 for column in self.flag_columns},
+            "categories": {column: {} for column in self.category_columns},
+            "values": {column: QuantileSketch(self.relative_accuracy) for column in self.value_columns},
+        }
 
-        # Extract CPR number from table in the document
-        cpr_number = extract_cpr_number_from_table(doc)
+    def add(self, data):
+        key = tuple(group(data) for group in aggregate_groups.values())
+        if key not in self.groups:
+            self.groups[key] = self.new_group()
+        for aggregate in (self.total, self.groups[key]):
+            aggregate["count"] += 1
+            for column in self.flag_columns:
+                if data.get(column) in (True, "True"):
+                    aggregate["flags"][column] += 1
+            for column in self.category_columns:
+                value = data.get(column)
+                if value is not None and value != "":
+                    counts = aggregate["categories"][column]
+                    counts[str(value)] = counts.get(str(value), 0) + 1
+            for column in self.value_columns:
+                value = record_number(data.get(column))
+                if value is not None:
+                    aggregate["values"][column].add(value)
+
+    def merge(self, other):
+        if (other.flag_columns, other.category_columns, other.value_columns) != (self.flag_columns, self.category_columns, self.value_columns):
+            raise ValueError("Cannot merge aggregates of different columns")
+        for key, group in other.groups.items():
+            if key not in self.groups:
+                self.groups[key] = self.new_group()
+            self.merge_group(self.groups[key], group)
+        self.merge_group(self.total, other.total)
+
+    def merge_group(self, aggregate, other):
+        aggregate["count"] += other["count"]
+        for column, count in other["flags"].items():
+            aggregate["flags"][column] += count
+        for column, counts in other["categories"].items():
+            for value, count in counts.items():
+                aggregate["categories"][column][value] = aggregate["categories"][column].get(value, 0) + count
+        for column, sketch in other["values"].items():
+            aggregate["values"][column].merge(sketch)
+
+    def group_dict(self, aggregate):
+        return {
+            "count": aggregate["count"],
+            "flags": aggregate["flags"],
+            "categories": aggregate["categories"],
+            "values": {column: sketch.to_dict() for column, sketch in aggregate["values"].items() if sketch.count},
+        }
 
-        # Extract autopsy date from table in the document
-        aut_date = extract_aut_date_from_table(doc)
-            
-        # Extract autopsy record number from table in the document
-        aut_number = extract_aut_number_from_table(doc)
+    def to_dict(self):
+        return {
+            "group_by": list(aggregate_groups),
+            "flag_columns": self.flag_columns,
+            "category_columns": self.category_columns,
+            "value_columns": self.value_columns,
+            "relative_accuracy": self.relative_accuracy,
+            "total": self.group_dict(self.total),
+            "groups": [dict(zip(aggregate_groups, key), **self.group_dict(self.groups[key])) for key in sorted(self.groups)],
+        }
 
-        # Extract if primary or supplementary report from the concatenated text
-        supp = extract_supp(doc_text)
-        
-        # Extract lung weights from the concatenated text
-        weights = extract_lung_weights(doc_text, keywords)
+    @classmethod
+    def from_dict(cls, data):
+        if data["group_by"] != list(aggregate_groups):
+            raise ValueError(f"The summary is grouped by {data['group_by']}, not {list(aggregate_groups)}")
+        aggregates = cls(data["flag_columns"], data["category_columns"], data["value_columns"], data["relative_accuracy"])
+
+        def read_group(aggregate, group):
+            aggregate["count"] = group["count"]
+            aggregate["flags"].update(group["flags"])
+            aggregate["categories"].update(group["categories"])
+            for column, sketch in group["values"].items():
+                aggregate["values"][column] = QuantileSketch.from_dict(sketch, aggregates.relative_accuracy)
+
+        read_group(aggregates.total, data["total"])
+        for group in data["groups"]:
+            key = tuple(group[name] for name in aggregate_groups)
+            aggregates.groups[key] = aggregates.new_group()
+            read_group(aggregates.groups[key], group)
+        return aggregates
+
+    def write(self, filename):
+        import json
+
+        with open(filename, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, ensure_ascii=False, indent=1)
+
+    @classmethod
+    def read(cls, filename):
+        import json
+
+        with open(filename, "r", encoding="utf-8") as file:
+            return cls.from_dict(json.load(file))
+
+# Aggregate summary of CSV files from export_to_csv (read row by row) and summary files (merged) - inputs ending in .json are summary files
+def aggregate_files(filenames, flag_columns=None, category_columns=None, value_columns=None):
+    aggregates = None
+    for filename in filenames:
+        if filename.lower().endswith(".json"):
+            other = Aggregates.read(filename)
+        else:
+            other = Aggregates(flag_columns, category_columns, value_columns)
+            with open(filename, "r", newline="", encoding="utf-16") as file:
+                for row in csv.DictReader(file):
+                    other.add(row)
+        if aggregates is None:
+            aggregates = other
+        else:
+            aggregates.merge(other)
+    return aggregates
+
+# This section reports the progress of a run. The console is updated every "interval" seconds instead of for every document, and the status
+# file (JSON) is rewritten atomically at the same rate, so other programs can follow the run: documents and MB per second, errors, queue depths
+# and the expected time left. The time left is estimated from the bytes left (large documents take longer to process), using the file sizes
+# found by the crawler. The messages printed by the extractors are counted, and the most frequent ones are shown with the progress.
+
+# Number of the most frequent extractor messages shown with the progress
+progress_top_messages = 5
+
+class ProgressReporter:
+    def __init__(self, crawl_state, schedule_state, records=None, sizes=None, skipped=None, interval=5, status_file=None, quiet=False):
+        self.crawl_state = crawl_state
+        self.schedule_state = schedule_state
+        self.records = records  # list or RecordSpill
+        self.sizes = {} if sizes is None else sizes
+        self.skipped = [] if skipped is None else skipped
+        self.interval = interval
+        self.status_file = status_file
+        self.quiet = quiet
+        self.start_time = time.time()
+        self.last_update = self.start_time
+        self.memory_mb = None  # memory use of the main process, set by the caller
+        self.messages_shown = 0  # number of extractor messages at the last progress line
+
+    def status(self, finished=False):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        files_done = self.schedule_state.get("files_done", 0)
+        bytes_done = self.schedule_state.get("bytes_done", 0)
+
+        # The totals are estimates until the crawler is done - the bytes of the folders not listed yet are estimated from the average file size
+        files_found = self.crawl_state.get("files", 0)
+        estimated_files = self.crawl_state.get("estimated_total") or files_found
+        skipped_bytes = sum(self.sizes.get(file_path, 0) for file_path in self.skipped)
+        files_total = max(estimated_files - len(self.skipped), files_done)
+        bytes_total = self.crawl_state.get("bytes", 0) * estimated_files / files_found if files_found else 0
+        bytes_total = max(bytes_total - skipped_bytes, bytes_done)
+
+        if bytes_done:
+            time_left = (bytes_total - bytes_done) * elapsed / bytes_done
+        elif files_done:
+            time_left = (files_total - files_done) * elapsed / files_done
+        else:
+            time_left = None
+
+        return {
+            "state": "finished" if finished else "running",
+            "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.start_time)),
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed_s": round(elapsed, 1),
+            "files_done": files_done,
+            "files_total": files_total,
+            "files_total_is_estimate": not self.crawl_state.get("done", False),
+            "mb_done": round(bytes_done / (1024 * 1024), 2),
+            "mb_total": round(bytes_total / (1024 * 1024), 2),
+            "percent": round(100 * bytes_done / bytes_total, 2) if bytes_total else None,
+            "docs_per_s": round(files_done / elapsed, 2),
+            "mb_per_s": round(bytes_done / (1024 * 1024) / elapsed, 3),
+            "errors": self.schedule_state.get("errors", 0),
+            "skipped_quarantined": len(self.skipped),
+            "time_left_s": None if time_left is None else round(time_left),
+            "time_left": None if time_left is None else f"{int(time_left // 3600)}:{int(time_left % 3600 // 60):02d}:{int(time_left % 60):02d}",
+            "queues": {
+                "crawl_folders_pending": self.crawl_state.get("folders_pending", 0),
+                "files_queued": self.schedule_state.get("queued", 0),
+                "records_waiting": self.schedule_state.get("waiting", 0),
+                "records_waiting_mb": round(self.schedule_state.get("waiting_bytes", 0) / (1024 * 1024), 1),
+            },
+            "records": {
+                "in_memory": None if self.records is None else len(self.records.records) if isinstance(self.records, RecordSpill) else len(self.records),
+                "spilled": None if self.records is None else len(self.records.offsets) if isinstance(self.records, RecordSpill) else 0,
+            },
+            "memory_mb": None if self.memory_mb is None else round(self.memory_mb),
+            "extractor_messages": {
+                "total": sum(self.schedule_state.get("extractor_messages", {}).values()),
+                "top": sorted(self.schedule_state.get("extractor_messages", {}).items(), key=lambda item: -item[1])[:progress_top_messages],
+            },
+        }
 
-        # Extract organ sizes
-        organ_sizes = extract_organ_size(doc_text, organ_keywords)
+    # Update the console and the status file if "interval" seconds have passed since the last update (or the run is finished)
+    def update(self, finished=False):
+        import json
+
+        now = time.time()
+        if not finished and now - self.last_update < self.interval:
+            return
+        self.last_update = now
+
+        status = self.status(finished)
+        if self.status_file:
+            write_file_atomic(self.status_file, lambda file: json.dump(status, file, indent=1))
+        if not self.quiet or finished:
+            print(f"Progress: {status['files_done']} of {'~' if status['files_total_is_estimate'] else ''}{status['files_total']} files"
+                  f" ({'-' if status['percent'] is None else status['percent']}% of the bytes), {status['docs_per_s']} docs/s, {status['mb_per_s']} MB/s,"
+                  f" {status['errors']} errors | time left {status['time_left'] or '-'}")
+
+        # The extractor messages since the last progress line
+        messages = status["extractor_messages"]
+        if not self.quiet and messages["total"] > self.messages_shown:
+            self.messages_shown = messages["total"]
+            shown = sum(count for message, count in messages["top"])
+            print(f"Extractor messages ({messages['total']}): " + ", ".join(f"{count} x {message}" for message, count in messages["top"])
+                  + (f" and {messages['total'] - shown} other" if messages["total"] > shown else ""))
+
+# Process all docx-files in the folder and return the data for all documents and the list of all columns.
+# This collects the records from iter_records - see iter_records for the workers, ordered, timeout, mem_limit_mb and quarantine settings.
+# crawl_threads and listing_cache_file are used by crawl_docx_files (listing_cache_file=None lists all folders every time), cache_file and
+# cache_size_mb by the result cache (see extract_document). The folders are listed concurrently, so the order of the records can differ between runs.
+# text_store_file stores the long text columns as references into a text store (see iter_records).
+# memory_budget_mb is the memory the main process may use for records: 3/4 for the collected records (the rest are written to spill_file,
+# see RecordSpill) and 1/4 for records waiting for earlier documents when ordered=True (the workers are not given new documents while this is full).
+# With a budget, the memory of the main process is also checked after each record, and the next records go directly to the spill file when the
+# process uses more than the budget - this check needs psutil (without it only the estimated record sizes are counted). The budget does not cover
+# the worker processes (see mem_limit_mb). Without a budget, the records are returned as a list.
+# The memory use of each stage is printed every report_interval seconds.
+# paragraph_cache_file keeps the results of the paragraph functions (see paragraph_result) for the next run.
+# aggregate_file is a summary file (see Aggregates) with the aggregates of the records, computed as the records are extracted.
+# The progress is printed every progress_interval seconds and written to status_file (see ProgressReporter). quiet=True only prints
+# the final progress, and the output of the extractors is discarded.
+def process_documents(folder_path, keywords, keyword_COD=None, keyword_2_COD=None, organ_keywords=None, keywordCT=None, workers=0, ordered=True,
+                      timeout=None, mem_limit_mb=None, quarantine_file="quarantine.csv", quarantine_policy="skip", crawl_threads=8, listing_cache_file=None,
+                      cache_file=None, cache_size_mb=1024, text_store_file=None, memory_budget_mb=None, spill_file=None, report_interval=60,
+                      paragraph_cache_file=None, aggregate_file=None, progress_interval=5, status_file=None, quiet=False):
+    # Initialize the record list that stores dictionaries of data for each document
+    print("Processsing docx-documents!")
+    all_data = [] if memory_budget_mb is None else RecordSpill(memory_budget_mb * 3 / 4, spill_file)
+    all_keys = OrderedDict()
 
-        # Extract wall thicknesses from the concatenated text
-        thicknesses = extract_wall_thicknesses(
-            doc_text, ["højre hjertekammer", "venstre hjertekammer", "hjerteskille"]
-        )
+    # The docx-files are processed as they are found by the crawler - the total number of files is estimated while crawling
+    crawl_state = {}
+    file_sizes = {}
+    docx_files = crawl_docx_files(folder_path, threads=crawl_threads, cache_file=listing_cache_file, sizes=file_sizes, state=crawl_state)
 
-        # Extract pleural fluid volume from the concatenated text
-        volumes = extract_pleural_fluid(doc_text, ["højre","venstre","bughule"])
-
-        # Extract height and weight from the concatenated text
-        height, bod_weight, bod_weight_unit = extract_height_weight(doc_text)
-
-        # Extract putrefaction from the concatenated text
-        putrefaction = extract_putrefaction(doc_text)
-
-        # Extract putrefaction level from text
-        putre_level = putrefaction_degree(doc_text)
-
-        # Extract keyword from text
-        keyword = check_word_in_text(doc_text, "autoerot")
-
-        # Extract age from the concatenated text
-        age, age_unit = extract_age(doc_text)
-
-        # Extract sex from the concatenated text
-        sex = extract_sex(doc_text)
-
-        # Check if COD keywords in the given list is present in the document, create dictionary
-        regex_dict = {
-            "uoplyst": r"ikke oplyst|uoplyst",
-            "drukning": r"drukning",
-            "hjertesvigt": r"akut hjertesvigt",
-            "forgiftning": r"forgiftning(?![^.]+(kulilte|cyanid))",
-            "hængning": r"hængning",
-            "skud": r"skudlæsion",
-            "stik_snit": r"stiklæsion|snitlæsion|stiksår|snitsår",
-            "forblødning": r"forblødning",
-            "forbrænding": r"forbrænding",
-            "lungebetændelse": r"lunge[^.]+betændelse|betændelse[^.]+lunge|lungebetændelse",
-            "ikke holdepunkt": r"ikke holdepunkt",
-            "supp_no_change": r"resultat[^.]+giver ikke|resultat[^.]+ændrer ikke",
-        }
-        keyword_COD_dict = search_for_COD_keywords(doc_text, regex_dict)
-        
-        # Look up COD paragraph and store whole paragraph as text variable
-        textCOD_dict = store_COD_text(doc_text)
-
-        # Look up vaccination sentences and store each sentence as text variable - up to two sentences
-        textVAC = store_vaccine_text(doc).replace("\n", " ")
-
-        # Look up findesteds paragraph and store whole paragraph as text variable
-        finde_text = store_finde_text(doc)
-
-        # Findeomstændigheder - dictionary of terms and associated regexes, that are checked in paragraphs with phrases such as "af disse papirer", "nu afdøde", etc. - check the function for all terms
-        findeomst_dict = {
-            "fundet_i_vand": (
-                r"(fundet|livløs|\bfandt|liggende|ligget|lå|nedsunket|under|\bflydende\b|drivende|bunden|ude i vandet|fik i|trukket op|optaget i|spottet|bjerget|fisket op|reddet)"
-                r"(?:(?![.,:]\s).)+(\bflydende|druknet|drivende|i vandet|af vandet|i en å|\bå\b|\bbrønd\b|sivbrønd|sivområde|trawl|under vand|lavt vand|swimmingpool|vandkanten"
-                r"|vandoverfladen|vandhul|fra båden|bælt\b|vandløb|dam\b|fiskedam|\bsø\b|søen\b|gadekær|på bunden|havbunden|saltvandsbassin|havnebassin|drevet i land"
-                r"|vandhul|bundgarn|farvand|fjord|voldgrav|strandkanten|havet\b|havstokken|\bkanal|\bhavn(?!et))"
-            ),
-            "trafik": r"påkørt|fører af|passager\b|færdselsuheld|trafikuheld|trafikulykke"
-        }
+    # Documents that were quarantined in a previous run are skipped, unless they should be retried
+    skipped = []
+    if quarantine_policy == "skip":
+        quarantine = read_quarantine(quarantine_file)
+        if quarantine:
+            docx_files = skip_quarantined(docx_files, quarantine, skipped)
 
-        findeomst_result = findeomst(doc, findeomst_dict)
-
-        # Look for keyCT in paragraphs with "CT" and following four paragraphs
-        keyCT_present = CT_search(doc, keywordCT)
-
-        # Look for "skumsvamp" in paragraphs and return all paragraphs where this is true
-        skum_para = skumsvampPara(doc)
-
-        # Look for "strip" in the whole document, return all paragraphs where "strip" is found as a single string
-        strip_text = stripPara(doc)
-
-        # Look for "tegn på sygdom*" in paragraphs and return all text in paragraph after the phrase
-        TPS = search_TPS(doc).replace("\n", " ")
-
-        #Look for "efter det oplyste" and return subsequent text until finding "mand|kvinde"
-        KS = kendtMed(doc)
-
-        #Look for "hjerteposen" and return all text in that paragraph
-        textHeart = hjerteText(doc).replace("\n", " ")
-
-        #Look for "Legemspulsåren og" and return all text in that paragraph
-        textAorta = aortaText(doc).replace("\n", " ")
-
-        #Look for "Halspulsårerne afgår" and return all text in that paragraph
-        textCarotid = carotidText(doc).replace("\n", " ")
-
-        #Compile list of paragraphs with lesion data
-        #lesions = extract_lesions(doc)
-
-        # Create a dictionary to store the data for this document
-        data = {
-            "File Name": filename,
-            "CPR Number": cpr_number,
-            "aut_number": aut_number,
-            "Prim_status": supp,
-            "Autopsy Date": aut_date,
-            "Age": age,
-            "Age unit": age_unit,
-            "Sex": sex,
-            **weights,  # Unpack the lung weights dictionary
-            **organ_sizes, #Unpack the organ sizes dictionary
-            **thicknesses,  # Unpack the wall thicknesses dictionary
-            **volumes, # Unpack the pleural fluid volumes dictionary
-            "Højde": height,
-            "Vægt": bod_weight,
-            "Vægtenhed": bod_weight_unit,
-            "Putrefaction": putrefaction,
-            "Putre_level": putre_level,
-            "Autoerot": keyword,
-            **keyword_COD_dict,  # Unpack COD keyword matches
-            "COD tekst": textCOD_dict,
-            "Finde tekst": finde_text,
-            "Vaccine text": textVAC,
-            **findeomst_result,
-            "keywordCT: "+str(keywordCT): keyCT_present,
-            "Skumsvamp tekst": skum_para,
-            "Strip_text": strip_text,
-            "TPS": TPS,
-            "Kendte sygdomme": KS,
-            "Hjertebeskrivelse": textHeart,
-            "Aortabeskrivelse": textAorta,
-            "Carotider_beskrivelse": textCarotid,
-            #"LW/HW": (weights.get("venstre lunge") + weights.get("Højre lunge"))/weights.get("Hjertet"),
-            #**lesions #unpack the lesions dictionary
-        }
+    aggregates = None
+    if aggregate_file:
+        keywords = default_keywords if keywords is None else keywords
+        aggregates = Aggregates(value_columns=aggregate_value_columns + [keyword.lower() for keyword in keywords])
+
+    schedule_state = {}
+    records = iter_records(docx_files, keywords, organ_keywords, keywordCT, workers=workers, ordered=ordered, timeout=timeout, mem_limit_mb=mem_limit_mb,
+                           quarantine_file=quarantine_file, quarantine_policy=quarantine_policy, cache_file=cache_file, cache_size_mb=cache_size_mb,
+                           sizes=file_sizes, text_store_file=text_store_file, max_buffer_mb=None if memory_budget_mb is None else memory_budget_mb / 4,
+                           state=schedule_state, paragraph_cache_file=paragraph_cache_file, quiet=quiet)
+
+    progress = ProgressReporter(crawl_state, schedule_state, all_data, file_sizes, skipped, interval=progress_interval, status_file=status_file, quiet=quiet)
+    report_time = time.time()
 
+    # Loop through all docx-files
+    for data in records:
         for key in data.keys():
             if key not in all_keys:
                 all_keys[key] = None
 
         # Append the data dictionary to the list
         all_data.append(data)
+        if aggregates is not None:
+            aggregates.add(data)
+
+        # With a budget, the memory is checked for each record - if the process uses more than the budget, the next records go directly to the spill file
+        reporting = time.time() - report_time > report_interval
+        if memory_budget_mb is not None or reporting:
+            process_mb = _process_memory_mb(os.getpid())
+            if memory_budget_mb is not None and process_mb is not None and process_mb > memory_budget_mb:
+                all_data.stop_memory()
+            progress.memory_mb = process_mb
+
+        # Report the memory use of each stage
+        if reporting:
+            report_time = time.time()
+            if not quiet:
+                if isinstance(all_data, RecordSpill):
+                    records_text = f"{len(all_data.records)} in memory ({all_data.memory_bytes / (1024 * 1024):.1f} MB), {len(all_data.offsets)} spilled"
+                else:
+                    records_text = f"{len(all_data)} in memory"
+                print(f"Memory: process {'n/a' if process_mb is None else f'{process_mb:.0f} MB'}"
+                      f" | crawl: {crawl_state['files']} files found, {crawl_state['folders_pending']} folders pending, {len(file_sizes)} sizes"
+                      f" | workers: {schedule_state.get('queued', 0)} files queued, {schedule_state.get('waiting', 0)} records waiting ({schedule_state.get('waiting_bytes', 0) / (1024 * 1024):.1f} MB)"
+                      f" | records: {records_text}")
 
-        # Calculate processing time for processed file
-        elapsed_time = time.time() - start_time
-        total_time += elapsed_time
-        num_files_processed += 1
-
-        # Compute the running average of file processing time
-        average_time_per_file = total_time / num_files_processed
-
-        # Estimate the remaining time
-        remaining_files = total_files - num_files_processed
-        remaining_time = average_time_per_file * remaining_files
-        remaining_time_hms = time.strftime("%H:%M:%S", time.gmtime(remaining_time))
+        progress.update()
 
-        # Calculate progress percentage
-        progress_percentage = (num_files_processed / len(docx_files)) * 100
+    progress.update(finished=True)
 
-        # Print the progress percentage and estimated remaining time
-        print(f"Conversion {progress_percentage:.2f}% complete.")
-        print(f"Expected time left to completion: {remaining_time_hms}")
-        
-        print(filename)
+    # Total number of docx-files
+    print("The total number of word-files is: " + str(crawl_state["files"]))
+    if skipped:
+        print("Skipped " + str(len(skipped)) + " quarantined files")
+    print_paragraph_cache_stats(schedule_state.get("paragraph_cache", {}))
+    if aggregates is not None:
+        aggregates.write(aggregate_file)
+        print(f"Wrote the aggregates of {aggregates.total['count']} records in {len(aggregates.groups)} groups to {aggregate_file}")
 
     # Sort lesion columns for each document
     #for data in all_data:
@@ -1090,13 +2978,17 @@ def process_documents(folder_path, keywords, keyword_COD, keyword_2_COD):
     return all_data, list(all_keys.keys())
     
 
-# export_to_csv now uses the "all_keys" variable to create the field names, so even if first document is missing values, it should not produce an error
-# ADDED 2025-08-08 export_to_csv now finds duplicate CPR numbers. If the have the same aut_number, only the one with highest "File Name" is kept. If there are multiple aut_num, all duplicates are kept.
-# A log file with duplicates, including which are removed, are created and stored in a separate CSV-file. 
-def export_to_csv(data, all_keys, csv_filename):
-    # Group entries by CPR Number
+# Find the records with duplicate CPR numbers - see export_to_csv. Returns the entries to keep (with the position of the record in data)
+# and the duplicates log.
+# separate_supp=True only compares supplementary reports with other supplementary reports (and primary reports with primary reports), so a
+# supplementary report with the same CPR Number and aut_number as its primary report is kept (used by link_case_records)
+def deduplicate_records(data, separate_supp=False):
+    # Group entries by CPR Number - the entries only hold the fields used here, the autopsy date (used by export_dataset), the report status
+    # (used by link_case_records) and the position of the record
     cpr_groups = {}
-    for entry in data:
+    for position, record in enumerate(data):
+        entry = {"File Name": record.get("File Name"), "CPR Number": record.get("CPR Number"), "aut_number": record.get("aut_number"),
+                 "Autopsy Date": record.get("Autopsy Date"), "Prim_status": record.get("Prim_status"), "position": position}
         cpr_number = entry.get("CPR Number")
         if cpr_number not in cpr_groups:
             cpr_groups[cpr_number] = []
@@ -1111,15 +3003,15 @@ def export_to_csv(data, all_keys, csv_filename):
             filtered_data.append(entries[0])
             continue
 
-        # Group by aut_number
+        # Group by aut_number (and report status with separate_supp)
         aut_groups = {}
         for entry in entries:
-            aut_number = entry.get("aut_number")
-            if aut_number not in aut_groups:
-                aut_groups[aut_number] = []
-            aut_groups[aut_number].append(entry)
+            aut_key = (entry.get("aut_number"), separate_supp and entry.get("Prim_status") == "Supp")
+            if aut_key not in aut_groups:
+                aut_groups[aut_key] = []
+            aut_groups[aut_key].append(entry)
 
-        for aut_number, aut_entries in aut_groups.items():
+        for (aut_number, supp), aut_entries in aut_groups.items():
             if len(aut_entries) == 1:
                 # Unique aut_number within duplicate CPR group — keep it
                 filtered_data.append(aut_entries[0])
@@ -1148,32 +3040,1034 @@ def export_to_csv(data, all_keys, csv_filename):
                     "Omitted": "No"
                 })
 
-    # Write the filtered data to the main CSV file
-    with open(csv_filename, "w", newline="", encoding="utf-16") as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=all_keys, quoting=csv.QUOTE_ALL)
-        writer.writeheader()
-        writer.writerows(filtered_data)
+    return filtered_data, duplicates_log
 
-    # Write the duplicates log to a separate CSV file
+# Write the duplicates log to a separate CSV file
+def write_duplicates_log(duplicates_log):
     if duplicates_log:
         with open("duplicates.csv", "w", newline="", encoding="utf-8") as log_file:
             log_writer = csv.DictWriter(log_file, fieldnames=["File Name", "CPR Number", "aut_number", "Omitted"])
             log_writer.writeheader()
             log_writer.writerows(duplicates_log)
-        
-# Example usage:
-folder_path = r"S:\RPA\7. Retspatologi\Andet\JOB_automatiskdataudtræk_CJW\Workspace\Primære erklæringer 1992-2024"
-#folder_path = r"S:\RPA\7. Retspatologi\Andet\JOB_automatiskdataudtræk_CJW\Workspace\test"
-keywords = ["Højre lunge", "Venstre lunge", "Hjerte", "Milt", "Leveren", "Hjernen", "Højre nyre", "Venstre nyre"]
-organ_keywords = ["Hjertet", "Leveren", "Højre nyre", "Venstre nyre"]
-output_csv_filename = "output_2025_08_26_supp.csv"
-keyword_COD = "drukning"  # Define keywordCOD
-keyword_2_COD = "akut hjertesvigt"
-keyword_3_COD = "forgiftning"
-keywordCT = "hjertepose" #Define keyword to look for in CT-paragraphs
-result, keys = process_documents(folder_path, keywords, keyword_COD, keyword_2_COD)
-
-# Export the result to a CSV file
-export_to_csv(result, keys, output_csv_filename)
-# Write your code here :-)
 
+# export_to_csv now uses the "all_keys" variable to create the field names, so even if first document is missing values, it should not produce an error
+# ADDED 2025-08-08 export_to_csv now finds duplicate CPR numbers. If the have the same aut_number, only the one with highest "File Name" is kept. If there are multiple aut_num, all duplicates are kept.
+# A log file with duplicates, including which are removed, are created and stored in a separate CSV-file. 
+# data can be any iterable of records, e.g. export_to_csv(iter_records(folder_path), None, csv_filename) - if all_keys is None, the columns are collected from the records.
+# The export reads the records twice: first only the CPR Number, aut_number and File Name of each record for the duplicate check, then each record
+# that is kept as it is written - so a RecordSpill from process_documents is not loaded into memory.
+def export_to_csv(data, all_keys, csv_filename):
+    if all_keys is None or not hasattr(data, "__getitem__"):
+        data = list(data)
+    if all_keys is None:
+        all_keys = list(OrderedDict((key, None) for entry in data for key in entry).keys())
+
+    filtered_data, duplicates_log = deduplicate_records(data)
+
+    # Write the filtered data to the main CSV file
+    with open(csv_filename, "w", newline="", encoding="utf-16") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=all_keys, quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        for entry in filtered_data:
+            writer.writerow(data[entry["position"]])
+
+    write_duplicates_log(duplicates_log)
+
+# This section writes the output as a dataset partitioned by autopsy year instead of one CSV file: dataset_dir/year=1995/data.csv etc.
+# (the same format as export_to_csv), and dataset_dir/manifest.json with the file, number of rows, columns and a content hash of each
+# partition. The rows of a partition are sorted by File Name, so a partition only gets another hash if its documents have changed -
+# only these partitions are written again, and partitions without documents are removed. Readers use the manifest to read only
+# the years they need (see read_dataset). Records without a valid autopsy date are in the partition year=unknown.
+
+dataset_manifest_name = "manifest.json"
+
+# File-like object that only computes the hash of what is written, e.g. by a csv.writer
+class HashWriter:
+    def __init__(self):
+        import hashlib
+        self.hasher = hashlib.blake2b(digest_size=16)
+
+    def write(self, text):
+        self.hasher.update(text.encode("utf-8"))
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+def read_dataset_manifest(dataset_dir):
+    import json
+
+    try:
+        with open(os.path.join(dataset_dir, dataset_manifest_name), "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"partition_by": "year", "partitions": {}}
+
+# Write a file by writing a temporary file and replacing the file, so readers never see a half-written file
+def write_file_atomic(filename, write, encoding="utf-8"):
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w", newline="", encoding=encoding) as file:
+        write(file)
+    os.replace(temp_filename, filename)
+
+# Write the records (data and all_keys as for export_to_csv, duplicates are removed in the same way) to the dataset in dataset_dir.
+# Each partition has the columns of its own records (in the order they first occur), so a partition does not change when a column
+# is added to the documents of another year. Returns the number of partitions written, unchanged and removed.
+def export_dataset(data, all_keys, dataset_dir):
+    import json
+    import shutil
+
+    if all_keys is None or not hasattr(data, "__getitem__"):
+        data = list(data)
+    if all_keys is None:
+        all_keys = list(OrderedDict((key, None) for entry in data for key in entry).keys())
+
+    filtered_data, duplicates_log = deduplicate_records(data)
+    partitions = {}  # year: entries
+    for entry in filtered_data:
+        year = record_year(entry) or "unknown"
+        partitions.setdefault(year, []).append(entry)
+
+    os.makedirs(dataset_dir, exist_ok=True)
+    manifest = read_dataset_manifest(dataset_dir)
+    old_partitions = manifest["partitions"]
+    new_partitions = OrderedDict()
+    written = 0
+    for year in sorted(partitions):
+        entries = sorted(partitions[year], key=lambda entry: (str(entry["File Name"]), entry["position"]))
+        columns = OrderedDict()
+        for entry in entries:
+            columns.update(dict.fromkeys(data[entry["position"]]))
+        columns = list(columns)
+
+        def write_rows(file):
+            writer = csv.DictWriter(file, fieldnames=columns, quoting=csv.QUOTE_ALL, extrasaction="ignore")
+            writer.writeheader()
+            for entry in entries:
+                writer.writerow(data[entry["position"]])
+
+        hash_writer = HashWriter()
+        write_rows(hash_writer)
+        partition = {"file": f"year={year}/data.csv", "rows": len(entries), "columns": columns, "hash": hash_writer.hexdigest()}
+        filename = os.path.join(dataset_dir, partition["file"])
+        if old_partitions.get(year) != partition or not os.path.exists(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            write_file_atomic(filename, write_rows, encoding="utf-16")
+            written += 1
+        new_partitions[year] = partition
+
+    removed = [year for year in old_partitions if year not in new_partitions]
+    for year in removed:
+        shutil.rmtree(os.path.join(dataset_dir, os.path.dirname(old_partitions[year]["file"])), ignore_errors=True)
+
+    manifest = {"partition_by": "year", "encoding": "utf-16", "columns": list(all_keys), "partitions": new_partitions}
+    write_file_atomic(os.path.join(dataset_dir, dataset_manifest_name), lambda file: json.dump(manifest, file, ensure_ascii=False, indent=1))
+    write_duplicates_log(duplicates_log)
+    return written, len(new_partitions) - written, len(removed)
+
+# Read the rows of the dataset, only from the partitions of the given years (None = all years, "unknown" = no valid autopsy date)
+def read_dataset(dataset_dir, years=None):
+    manifest = read_dataset_manifest(dataset_dir)
+    for year, partition in manifest["partitions"].items():
+        if years is not None and year not in years:
+            continue
+        with open(os.path.join(dataset_dir, partition["file"]), "r", newline="", encoding="utf-16") as file:
+            yield from csv.DictReader(file)
+
+# Write the rows of the selected years of the dataset to one CSV file (the columns of all partitions). Returns the number of rows.
+def export_dataset_years(dataset_dir, csv_filename, years=None):
+    manifest = read_dataset_manifest(dataset_dir)
+    columns = OrderedDict()
+    for year, partition in manifest["partitions"].items():
+        if years is None or year in years:
+            columns.update(dict.fromkeys(partition["columns"]))
+    num_rows = 0
+    with open(csv_filename, "w", newline="", encoding="utf-16") as file:
+        writer = csv.DictWriter(file, fieldnames=list(columns), quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        for row in read_dataset(dataset_dir, years):
+            writer.writerow(row)
+            num_rows += 1
+    return num_rows
+
+# This section links supplementary reports to their primary report, so each autopsy gets one case record with the primary and supplementary fields side by side.
+# Hash indexes are built on CPR Number, aut_number and Autopsy Date, so the linkage runs in linear time over the result set.
+# A supplementary report is linked to the primary report with (in order of preference):
+#   the same CPR Number and aut_number, the same aut_number (if only one primary report has it), the same CPR Number and Autopsy Date,
+#   or the same CPR Number (if the CPR Number only has one primary report).
+# If several primary reports have the same key, the one with the highest "File Name" is used (as in export_to_csv).
+
+link_missing_values = {None, "", "No CPR match", "No match", "No date"}
+
+def _link_key(entry, fields):
+    key = tuple(entry.get(field) for field in fields)
+    if any(value in link_missing_values for value in key):
+        return None
+    return key
+
+def _add_to_index(index, key, position):
+    if key is not None:
+        index.setdefault(key, []).append(position)
+
+# Returns the primary report position for the key - None if no match, or if the primary reports with the key have different values of
+# distinct_field (e.g. an aut_number used for two CPR Numbers is not a unique match)
+def _lookup_link(index, key, primaries, distinct_field=None):
+    if key is None or key not in index:
+        return None
+    positions = index[key]
+    if distinct_field and len({primaries[position].get(distinct_field) for position in positions}) > 1:
+        return None
+    return max(positions, key=lambda position: primaries[position].get("File Name") or "")
+
+# data is a list of records or a RecordSpill - the linkage only keeps the link fields of each record in memory, and the returned case records
+# are made one at a time (a generator) when they are written. The duplicates are removed first, as in the main CSV file (see deduplicate_records),
+# but a supplementary report is only a duplicate of another supplementary report - not of the primary report it belongs to.
+def link_case_records(data, all_keys):
+    entries, duplicates_log = deduplicate_records(data, separate_supp=True)
+    entries.sort(key=lambda entry: entry["position"])
+    primaries = [entry for entry in entries if entry.get("Prim_status") != "Supp"]
+    supplementaries = [entry for entry in entries if entry.get("Prim_status") == "Supp"]
+
+    # Build the hash indexes on the primary reports
+    index_cpr_aut = {}
+    index_aut = {}
+    index_cpr_date = {}
+    index_cpr = {}
+    for position, entry in enumerate(primaries):
+        _add_to_index(index_cpr_aut, _link_key(entry, ["CPR Number", "aut_number"]), position)
+        _add_to_index(index_aut, _link_key(entry, ["aut_number"]), position)
+        _add_to_index(index_cpr_date, _link_key(entry, ["CPR Number", "Autopsy Date"]), position)
+        _add_to_index(index_cpr, _link_key(entry, ["CPR Number"]), position)
+
+    # Link each supplementary report to a primary report
+    linked = {}
+    unlinked = []
+    for entry in supplementaries:
+        for index, fields, distinct_field, method in [
+            (index_cpr_aut, ["CPR Number", "aut_number"], None, "CPR+aut_number"),
+            (index_aut, ["aut_number"], "CPR Number", "aut_number"),
+            (index_cpr_date, ["CPR Number", "Autopsy Date"], None, "CPR+date"),
+            (index_cpr, ["CPR Number"], "aut_number", "CPR"),
+        ]:
+            position = _lookup_link(index, _link_key(entry, fields), primaries, distinct_field)
+            if position is not None:
+                linked.setdefault(position, []).append((entry, method))
+                break
+        else:
+            unlinked.append(entry)
+
+    max_supp = max([len(supps) for supps in linked.values()] + [1 if unlinked else 0])
+
+    # Create one case record per primary report, with the supplementary reports as "Supp 1: ...", "Supp 2: ..." columns
+    def make_case_records():
+        for position, entry in enumerate(primaries):
+            supps = sorted(linked.get(position, []), key=lambda supp: supp[0].get("File Name") or "")
+            record = {"Case status": "Prim", "Linked supp": len(supps), "Link method": " / ".join(method for supp, method in supps)}
+            record.update(data[entry["position"]])
+            for number, (supp, method) in enumerate(supps, start=1):
+                for key, value in data[supp["position"]].items():
+                    record[f"Supp {number}: {key}"] = value
+            yield record
+
+        # Supplementary reports without a primary report get their own case record
+        for supp in unlinked:
+            record = {"Case status": "Supp only", "Linked supp": 1, "Link method": "unlinked"}
+            for key, value in data[supp["position"]].items():
+                record[f"Supp 1: {key}"] = value
+            yield record
+
+    case_keys = ["Case status", "Linked supp", "Link method"] + list(all_keys)
+    for number in range(1, max_supp + 1):
+        case_keys += [f"Supp {number}: {key}" for key in all_keys]
+
+    print("Case records: " + str(len(primaries) + len(unlinked)) + ", linked supplementary reports: " + str(sum(len(supps) for supps in linked.values())) + ", unlinked: " + str(len(unlinked))
+          + ", duplicates omitted: " + str(sum(1 for entry in duplicates_log if entry["Omitted"] == "Yes")))
+
+    return make_case_records(), case_keys
+
+def export_case_records(case_records, case_keys, csv_filename):
+    with open(csv_filename, "w", newline="", encoding="utf-16") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=case_keys, quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        writer.writerows(case_records)
+
+# This section compares the output CSV files of two runs, e.g. before and after a pattern change. The rows are joined on File Name
+# (the n'th row with a file name in one file is joined with the n'th row with that name in the other). The files are read a few times
+# instead of being loaded: first a hash of each old row is stored, then the new rows with another hash are found, and only for these rows
+# the hash of each column is kept and compared. Columns that are only in one of the files are listed, and their values are not compared.
+
+# Read the rows of a CSV file from export_to_csv as (key, values) - the key is (File Name, number of earlier rows with the file name),
+# and values are the values of the given columns (a tuple)
+def iter_csv_rows(csv_filename, columns, encoding="utf-16"):
+    from operator import itemgetter
+
+    seen = {}
+    with open(csv_filename, "r", newline="", encoding=encoding) as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        name_position = header.index("File Name")
+        positions = [header.index(column) for column in columns]
+        get_values = itemgetter(*positions) if len(positions) > 1 else lambda row: tuple(row[position] for position in positions)
+        for row in reader:
+            name = row[name_position]
+            number = seen.get(name, 0)
+            seen[name] = number + 1
+            yield (name, number), get_values(row)
+
+def read_csv_columns(csv_filename, encoding="utf-16"):
+    with open(csv_filename, "r", newline="", encoding=encoding) as file:
+        return next(csv.reader(file), [])
+
+# Compare two output CSV files. Returns a dictionary with the number of rows that are added, removed, changed and unchanged, the number of
+# changed rows for each column, the columns that are only in one file (with the number of non-empty values), and up to "samples"
+# (File Name, old value, new value) for each changed column.
+def diff_csv(old_filename, new_filename, samples=5, encoding="utf-16"):
+    from array import array
+
+    old_columns = read_csv_columns(old_filename, encoding)
+    new_columns = read_csv_columns(new_filename, encoding)
+    columns = [column for column in old_columns if column in new_columns]
+    old_only = [column for column in old_columns if column not in new_columns]
+    new_only = [column for column in new_columns if column not in old_columns]
+
+    # The hash of each old row (only the columns in both files)
+    old_hashes = {}
+    old_only_counts = [0] * len(old_only)
+    for key, values in iter_csv_rows(old_filename, columns + old_only, encoding):
+        old_hashes[key] = hash(values[:len(columns)])
+        for number, value in enumerate(values[len(columns):]):
+            if value:
+                old_only_counts[number] += 1
+
+    # The new rows that are added or have another hash - for the changed rows, the hash of each column is kept
+    added = []
+    new_only_counts = [0] * len(new_only)
+    changed = {}  # key: column hashes of the new row
+    num_new = 0
+    for key, values in iter_csv_rows(new_filename, columns + new_only, encoding):
+        num_new += 1
+        for number, value in enumerate(values[len(columns):]):
+            if value:
+                new_only_counts[number] += 1
+        values = values[:len(columns)]
+        old_hash = old_hashes.pop(key, None)
+        if old_hash is None:
+            added.append(key[0])
+        elif old_hash != hash(values):
+            changed[key] = array("q", map(hash, values))
+    removed = [key[0] for key in old_hashes]
+    del old_hashes
+
+    # Compare the columns of the changed rows, and keep the old values of the samples
+    column_changes = [0] * len(columns)
+    sample_values = [OrderedDict() for column in columns]  # for each column {key: [old value, new value]}
+    if changed:
+        for key, values in iter_csv_rows(old_filename, columns, encoding):
+            new_hashes = changed.get(key)
+            if new_hashes is None:
+                continue
+            for number, value in enumerate(values):
+                if hash(value) != new_hashes[number]:
+                    column_changes[number] += 1
+                    if len(sample_values[number]) < samples:
+                        sample_values[number][key] = [value, None]
+
+    # The new values of the samples
+    sample_keys = {}
+    for number, values in enumerate(sample_values):
+        for key in values:
+            sample_keys.setdefault(key, []).append(number)
+    if sample_keys:
+        for key, values in iter_csv_rows(new_filename, columns, encoding):
+            for number in sample_keys.pop(key, []):
+                sample_values[number][key][1] = values[number]
+            if not sample_keys:
+                break
+
+    return {
+        "old_rows": num_new - len(added) + len(removed),
+        "new_rows": num_new,
+        "added": added,
+        "removed": removed,
+        "changed": len(changed),
+        "unchanged": num_new - len(added) - len(changed),
+        "column_changes": OrderedDict(sorted(((column, count) for column, count in zip(columns, column_changes) if count), key=lambda item: -item[1])),
+        "old_only_columns": OrderedDict(zip(old_only, old_only_counts)),
+        "new_only_columns": OrderedDict(zip(new_only, new_only_counts)),
+        "samples": OrderedDict((column, [(key[0], old, new) for key, (old, new) in values.items()]) for column, values in zip(columns, sample_values) if values),
+    }
+
+# This section is the sampling mode, used when tuning a pattern. A reproducible (seeded) sample of documents is drawn, stratified by year, folder or file size,
+# so all eras of report wording are represented. Only the selected extraction steps are run on the sample, and the column fill rates are compared
+# with the previous sample run.
+
+# Values that count as "not filled" in the fill rates
+sample_empty_values = [None, "", [], False, "No match", "No CPR match", "No date", "NO MENTION", "NO MATCH", "TPS pattern not found"]
+
+# Returns the stratum of a file - the year (the last 4-digit year in the path below root, or the year the file was modified), the folder, or the size class.
+# Only the part of the path below root is searched for the year, so a year in the name of the sampled folder itself (e.g. "Erklæringer 1992-2024") is not used.
+def sample_stratum(file_path, stratify, size_limits=None, root=None):
+    if stratify == "year":
+        relative_path = os.path.relpath(file_path, root) if root else file_path
+        years = re.findall(r"(?<!\d)(19[89]\d|20[0-4]\d)(?!\d)", relative_path)
+        if years:
+            return years[-1]
+        return time.strftime("%Y", time.localtime(os.path.getmtime(file_path)))
+    if stratify == "folder":
+        return os.path.dirname(file_path)
+    if stratify == "size":
+        size = os.path.getsize(file_path)
+        return "size " + str(sum(1 for limit in size_limits if size > limit))
+    return "all"
+
+# Draw a reproducible sample of n files, stratified by year, folder or size (quartiles).
+# The sample is divided between the strata in proportion to their size. root is the sampled folder (see sample_stratum).
+def sample_documents(file_paths, n, seed=1, stratify="year", root=None):
+    import random
+
+    file_paths = sorted(file_paths)
+    size_limits = None
+    if stratify == "size":
+        sizes = sorted(os.path.getsize(file_path) for file_path in file_paths)
+        size_limits = [sizes[len(sizes) * quartile // 4] for quartile in (1, 2, 3)] if sizes else []
+
+    strata = OrderedDict()
+    for file_path in file_paths:
+        strata.setdefault(sample_stratum(file_path, stratify, size_limits, root), []).append(file_path)
+
+    # Divide the sample between the strata (largest remainder method), with at least one file from each stratum
+    n = min(n, len(file_paths))
+    shares = {stratum: n * len(stratum_files) / len(file_paths) for stratum, stratum_files in strata.items()}
+    allocation = {stratum: max(1, int(share)) for stratum, share in shares.items()}
+    for stratum in sorted(shares, key=lambda stratum: int(shares[stratum]) - shares[stratum]):
+        if sum(allocation.values()) >= n:
+            break
+        if allocation[stratum] < len(strata[stratum]):
+            allocation[stratum] += 1
+
+    rng = random.Random(seed)
+    sample = []
+    for stratum, stratum_files in sorted(strata.items()):
+        sample += rng.sample(stratum_files, min(allocation[stratum], len(stratum_files)))
+
+    return sorted(sample), {stratum: len(stratum_files) for stratum, stratum_files in strata.items()}
+
+def _sample_value(value):
+    # Values are compared as they are written to the CSV file
+    return str(value) if value is not None else ""
+
+# Column fill rates (share of the records where the column is filled)
+def fill_rates(records):
+    counts = OrderedDict()
+    for record in records:
+        for key, value in record.items():
+            counts.setdefault(key, 0)
+            if value is None or value is False or (isinstance(value, (str, list)) and value in sample_empty_values):
+                continue
+            counts[key] += 1
+    return {key: count / len(records) for key, count in counts.items()} if records else {}
+
+# Run the selected steps on a sample and compare with the previous sample run, which is stored in state_file (JSON)
+def run_sample(folder_path, n=200, seed=1, stratify="year", steps=None, workers=0, state_file="sample_state.json", keywords=None, organ_keywords=None, keywordCT=None,
+               cache_file=None):
+    import json
+
+    start_time = time.time()
+    sample, strata = sample_documents(find_docx_files(folder_path), n, seed, stratify, root=folder_path)
+    print(f"Sample of {len(sample)} documents from {len(strata)} strata ({stratify})")
+
+    records = {}
+    for data in iter_records(sample, keywords, organ_keywords, keywordCT, workers=workers, steps=steps, quarantine_file=None, cache_file=cache_file):
+        records[data["File Name"]] = data
+    rates = fill_rates(list(records.values()))
+
+    previous = None
+    if state_file and os.path.exists(state_file):
+        with open(state_file, "r", encoding="utf-8") as file:
+            previous = json.load(file)
+
+    print(f"{'Column':<40}{'Fill rate':>10}{'Previous':>10}{'Changed':>9}")
+    for key, rate in rates.items():
+        if key == "File Name":
+            continue
+        previous_rate = ""
+        changed = ""
+        if previous is not None:
+            if key in previous["fill_rates"]:
+                previous_rate = f"{100 * previous['fill_rates'][key]:.1f}%"
+            # Number of documents in both samples where the value of the column has changed
+            changed = sum(1 for file_name, record in records.items()
+                          if file_name in previous["records"] and _sample_value(record.get(key)) != previous["records"][file_name].get(key, ""))
+        print(f"{key[:39]:<40}{100 * rate:>9.1f}%{previous_rate:>10}{changed:>9}")
+    if previous is not None:
+        for key in previous["fill_rates"]:
+            if key not in rates:
+                print(f"{key[:39]:<40}{'removed':>10}")
+
+    if state_file:
+        state = {
+            "settings": {"n": n, "seed": seed, "stratify": stratify, "steps": steps},
+            "fill_rates": rates,
+            "records": {file_name: {key: _sample_value(value) for key, value in record.items()} for file_name, record in records.items()},
+        }
+        with open(state_file, "w", encoding="utf-8") as file:
+            json.dump(state, file, ensure_ascii=False)
+
+    print(f"Sample run took {time.time() - start_time:.1f} s")
+    return records, rates
+
+# This section stores the parsed corpus (paragraphs, runs and table cells of each document) in a gzipped file with one JSON document per line,
+# so patterns can be tested on the whole corpus without reading the docx-files again.
+
+def write_corpus_index(file_paths, corpus_filename):
+    import gzip
+    import json
+
+    num_files = 0
+    with gzip.open(corpus_filename, "wt", encoding="utf-8") as corpus_file:
+        for file_path in file_paths:
+            try:
+                doc = load_document(file_path)
+            except Exception as e:
+                print(f"Error processing {os.path.basename(file_path)}: {e}")
+                continue
+            entry = {
+                "file": file_path,
+                "paragraphs": [paragraph.text for paragraph in doc.paragraphs],
+                "tables": [[[cell.text for cell in row.cells] for row in table.rows] for table in doc.tables],
+                # The runs of the paragraphs with more than one run (paragraph number: run texts) - used by store_vaccine_text
+                "runs": {str(number): [run.text for run in paragraph.runs] for number, paragraph in enumerate(doc.paragraphs) if len(paragraph.runs) > 1},
+            }
+            corpus_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            num_files += 1
+
+    return num_files
+
+# Yields the documents in a corpus file as dictionaries with "file", "paragraphs" and "tables"
+def read_corpus_index(corpus_filename):
+    import gzip
+    import json
+
+    with gzip.open(corpus_filename, "rt", encoding="utf-8") as corpus_file:
+        for line in corpus_file:
+            yield json.loads(line)
+
+# Returns the texts to search in a corpus document - each paragraph, each table cell, or the concatenated text (as doc_text in extract_document)
+def corpus_texts(entry, scope):
+    if scope == "tables":
+        return [cell for table in entry["tables"] for row in table for cell in row]
+    if scope == "text":
+        return [join_paragraphs(entry["paragraphs"])]
+    return entry["paragraphs"]
+
+# Search all documents in a corpus file with a compiled regex - returns the number of documents and matches and some sample hits with context
+def query_corpus(corpus_filename, pattern, scope="paragraphs", samples=10, context=60):
+    return query_entries(read_corpus_index(corpus_filename), pattern, scope, samples, context)
+
+# Search corpus documents (dictionaries with "file", "paragraphs" and "tables") with a compiled regex
+def query_entries(entries, pattern, scope="paragraphs", samples=10, context=60):
+    result = {"documents": 0, "documents_matched": 0, "matches": 0, "samples": []}
+
+    for entry in entries:
+        result["documents"] += 1
+        matches = 0
+        for text in corpus_texts(entry, scope):
+            for match in pattern.finditer(text):
+                matches += 1
+                if len(result["samples"]) < samples:
+                    hit = text[max(match.start() - context, 0):match.end() + context].replace("\n", " ")
+                    result["samples"].append((entry["file"], hit))
+        if matches:
+            result["documents_matched"] += 1
+            result["matches"] += matches
+
+    return result
+
+# Stand-in for a docx document made from a corpus entry, so the extraction steps can run on the corpus. It has the paragraphs (with text and runs)
+# and tables (rows, cells, text) that the extractors use. Corpus files from before the runs were stored get one run per paragraph.
+def corpus_document(entry):
+    from types import SimpleNamespace
+
+    runs = entry.get("runs", {})
+    paragraphs = [SimpleNamespace(text=text, runs=[SimpleNamespace(text=run) for run in runs.get(str(number), [text])])
+                  for number, text in enumerate(entry["paragraphs"])]
+    tables = [SimpleNamespace(rows=[SimpleNamespace(cells=[SimpleNamespace(text=cell) for cell in row]) for row in table]) for table in entry["tables"]]
+    return SimpleNamespace(paragraphs=paragraphs, tables=tables)
+
+# This section is the pattern exploration server. It loads a corpus file (see write_corpus_index) into a number of worker processes once - each worker
+# keeps its share of the documents in memory - and answers requests with JSON over HTTP:
+#   GET  /status - number of documents
+#   POST /query  - {"pattern": regex, "ignore_case": true, "scope": "paragraphs", "samples": 10} - as the query command
+#   POST /diff   - {"steps": ["findeomst"], "code": "findeomst_regex_dict['trafik'] = r'...'", "samples": 20}
+#                  runs the steps with the code applied (e.g. a changed pattern or extractor function) and returns the number of changed values per column
+#                  compared with the steps without the code, with sample changes.
+# The code in /diff requests is run in the worker processes, so the server only listens on localhost by default. Every request must also carry the
+# token printed when the server starts (header X-Corpus-Token), POST requests must be sent as application/json, and requests from a web page on
+# another origin are refused - so a web page open in the browser cannot send code to the server.
+
+# Worker process for the server - loads every shards'th document of the corpus, starting at document number shard, and answers requests from conn
+def _corpus_worker(conn, corpus_filename, shard, shards):
+    import contextlib
+
+    entries = [entry for number, entry in enumerate(read_corpus_index(corpus_filename)) if number % shards == shard]
+    docs = [corpus_document(entry) for entry in entries]
+    texts = [corpus_texts(entry, "text")[0] for entry in entries]
+    baseline = {}  # step name: columns for each document, without any code applied
+    conn.send(len(entries))
+
+    def run_step(step, number, settings):
+        ctx = {"doc": docs[number], "doc_text": texts[number], **settings}
+        try:
+            return step(ctx)
+        except Exception as e:
+            return {"Error": f"{type(e).__name__}: {e}"}
+
+    with open(os.devnull, "w") as devnull:
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            try:
+                with contextlib.redirect_stdout(devnull):
+                    if request["type"] == "query":
+                        conn.send(_corpus_worker_query(entries, request))
+                    else:
+                        conn.send(_corpus_worker_diff(entries, baseline, run_step, request))
+            except Exception as e:
+                conn.send({"error": f"{type(e).__name__}: {e}"})
+
+def _corpus_worker_query(entries, request):
+    pattern = re.compile(request["pattern"], re.IGNORECASE if request.get("ignore_case") else 0)
+    return query_entries(entries, pattern, request.get("scope", "paragraphs"), request.get("samples", 10))
+
+def _corpus_worker_diff(entries, baseline, run_step, request):
+    import copy
+
+    settings = {
+        "keywords": request.get("keywords", default_keywords),
+        "organ_keywords": request.get("organ_keywords", default_organ_keywords),
+        "keywordCT": request.get("keywordCT", default_keywordCT),
+    }
+    step_names = request.get("steps") or [step_name for step_name, step in extraction_steps]
+
+    # The columns without the code - kept for the next requests when the default settings are used
+    old_columns = []
+    for step_name, step in extraction_steps:
+        if step_name not in step_names:
+            continue
+        key = (step_name, repr(sorted(settings.items())))
+        if key not in baseline:
+            baseline[key] = [run_step(step, number, settings) for number in range(len(entries))]
+        old_columns.append(baseline[key])
+
+    # Run the code in this module, run the steps and put the module back as it was - the keyword lists and pattern dictionaries are copied,
+    # as the code can change them in place (e.g. findeomst_regex_dict["trafik"] = ...)
+    module_globals = globals()
+    saved = dict(module_globals)
+    saved.update({name: copy.deepcopy(value) for name, value in module_globals.items() if isinstance(value, (dict, list, set)) and not name.startswith("_")})
+    try:
+        _clear_worker_caches()
+        exec(request.get("code") or "", module_globals)
+        steps = [module_globals[step.__name__] for step_name, step in extraction_steps if step_name in step_names]
+        new_columns = [[run_step(step, number, settings) for number in range(len(entries))] for step in steps]
+    finally:
+        for name in list(module_globals):
+            if name not in saved:
+                del module_globals[name]
+        module_globals.update(saved)
+        _clear_worker_caches()
+
+    result = {"documents": len(entries), "documents_changed": 0, "columns": {}, "samples": []}
+    for number, entry in enumerate(entries):
+        changed = False
+        for old_step, new_step in zip(old_columns, new_columns):
+            old, new = old_step[number], new_step[number]
+            for column in list(old) + [column for column in new if column not in old]:
+                if old.get(column) == new.get(column) or column.startswith("_spans:"):
+                    continue
+                changed = True
+                result["columns"][column] = result["columns"].get(column, 0) + 1
+                if len(result["samples"]) < request.get("samples", 20):
+                    result["samples"].append({"file": entry["file"], "column": column, "old": old.get(column), "new": new.get(column)})
+        if changed:
+            result["documents_changed"] += 1
+    return result
+
+# Clear the caches that keep results, patterns or fingerprints made by the code of a /diff request (or made before it) - the changed code has to
+# run without them, and the next requests must not get results from it
+def _clear_worker_caches():
+    _paragraph_cache.clear()
+    _paragraph_scope_hashes.clear()
+    _step_fingerprints.clear()
+    measurement_pattern_cache.clear()
+
+# Combine the results from the workers - counts are added, and the samples are taken from the workers in turn up to the number requested
+def _merge_corpus_results(results, samples):
+    import itertools
+
+    merged = {}
+    for result in results:
+        for key, value in result.items():
+            if key == "samples":
+                continue
+            if isinstance(value, dict):
+                merged.setdefault(key, {})
+                for column, count in value.items():
+                    merged[key][column] = merged[key].get(column, 0) + count
+            elif isinstance(value, (int, float)):
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged[key] = value
+    merged["samples"] = [sample for group in itertools.zip_longest(*[result.get("samples", []) for result in results]) for sample in group if sample is not None][:samples]
+    return merged
+
+def serve_corpus(corpus_filename, host="127.0.0.1", port=8765, workers=None):
+    import hmac
+    import json
+    import multiprocessing
+    import secrets
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    workers = workers or os.cpu_count() or 1
+    connections = []
+    processes = []
+    for shard in range(workers):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_corpus_worker, args=(child_conn, corpus_filename, shard, workers), daemon=True)
+        process.start()
+        child_conn.close()
+        connections.append(parent_conn)
+        processes.append(process)
+    num_documents = sum(conn.recv() for conn in connections)
+    print(f"Loaded {num_documents} documents from {corpus_filename} in {workers} workers")
+
+    # New token for each start of the server
+    token = secrets.token_urlsafe(24)
+    allowed_origins = {f"http://{name}:{port}" for name in (host, "localhost", "127.0.0.1")}
+
+    # Send the request to all workers, so they work on their documents at the same time
+    def ask_workers(request):
+        for conn in connections:
+            conn.send(request)
+        results = [conn.recv() for conn in connections]
+        errors = [result["error"] for result in results if "error" in result]
+        if errors:
+            return {"error": errors[0]}
+        return _merge_corpus_results(results, request.get("samples", 10 if request["type"] == "query" else 20))
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, data):
+            body = json.dumps(data, ensure_ascii=False, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # (status, error message) if the request is refused, otherwise None
+        def refuse(self, post=False):
+            if not hmac.compare_digest(self.headers.get("X-Corpus-Token", "").encode("utf-8"), token.encode("utf-8")):
+                return 403, "Missing or wrong X-Corpus-Token header"
+            origin = self.headers.get("Origin")
+            if origin is not None and origin not in allowed_origins:
+                return 403, f"Requests from {origin} are not allowed"
+            if post and self.headers.get("Content-Type", "").split(";")[0].strip().lower() != "application/json":
+                return 415, "Content-Type must be application/json"
+            return None
+
+        def do_GET(self):
+            refused = self.refuse()
+            if refused:
+                self.send_json(refused[0], {"error": refused[1]})
+                return
+            if self.path == "/status":
+                self.send_json(200, {"documents": num_documents, "workers": workers, "corpus": corpus_filename})
+            else:
+                self.send_json(404, {"error": "Unknown path"})
+
+        def do_POST(self):
+            refused = self.refuse(post=True)
+            if refused:
+                self.send_json(refused[0], {"error": refused[1]})
+                return
+            if self.path not in ("/query", "/diff"):
+                self.send_json(404, {"error": "Unknown path"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except ValueError as e:
+                self.send_json(400, {"error": f"Invalid JSON: {e}"})
+                return
+            request["type"] = self.path[1:]
+            start_time = time.time()
+            result = ask_workers(request)
+            result["seconds"] = round(time.time() - start_time, 3)
+            self.send_json(400 if "error" in result else 200, result)
+
+    server = HTTPServer((host, port), Handler)
+    print(f"Serving on http://{host}:{port}")
+    print(f"Token (send as header X-Corpus-Token): {token}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for conn in connections:
+            conn.send(None)
+        for process in processes:
+            process.join(5)
+
+
+# This section defines the command line interface. Run "python aut_erkl_extract_docx_250829.py --help" for all options.
+#   extract - extract data from all docx-files in a folder to a CSV file
+#   bench   - time each extraction step on a number of documents
+#   sample  - run selected extraction steps on a stratified sample of documents and compare with the previous sample run
+#   index   - read all docx-files in a folder once and store the paragraphs and table cells in a corpus file
+#   query   - search a corpus file with a regex, e.g. when developing a new pattern
+#   cache   - show the hit rates of the result cache (extract --cache)
+#   expand  - replace the text references in a CSV file (extract --text-store) by the full text
+#   serve   - keep a corpus file in memory and answer pattern queries and step diffs over HTTP (see serve_corpus)
+#   aggregate - summarize CSV files from extract and merge summary files (extract --aggregate)
+#   diff    - compare the output CSV files of two runs (which documents and columns changed)
+#   select  - write the selected years of a dataset (extract --dataset) to one CSV file
+
+def command_extract(args):
+    result, keys = process_documents(args.folder, args.keywords, organ_keywords=args.organ_keywords, keywordCT=args.keyword_ct,
+                                     workers=args.workers, ordered=not args.unordered, timeout=args.timeout, mem_limit_mb=args.mem_limit, quarantine_file=args.quarantine_file, quarantine_policy=args.quarantine_policy,
+                                     crawl_threads=args.crawl_threads, listing_cache_file=args.listing_cache, cache_file=args.cache, cache_size_mb=args.cache_size_mb,
+                                     text_store_file=args.text_store, memory_budget_mb=args.memory_budget_mb, spill_file=args.spill_file,
+                                     paragraph_cache_file=args.paragraph_cache, aggregate_file=args.aggregate,
+                                     progress_interval=args.progress_interval, status_file=args.status_file, quiet=args.quiet)
+
+    try:
+        # Export the result to a CSV file, or to a dataset partitioned by year
+        if args.dataset:
+            written, unchanged, removed = export_dataset(result, keys, args.dataset)
+            print(f"Dataset {args.dataset}: {written} partitions written, {unchanged} unchanged, {removed} removed")
+        else:
+            export_to_csv(result, keys, args.output)
+
+        # Link supplementary reports to their primary reports and export one case record per autopsy
+        if args.cases:
+            cases, case_keys = link_case_records(result, keys)
+            export_case_records(cases, case_keys, args.cases)
+    finally:
+        if isinstance(result, RecordSpill):
+            result.close()
+
+def command_bench(args):
+    import contextlib
+
+    docx_files = find_docx_files(args.folder)[:args.limit]
+    step_times = OrderedDict()
+    num_files = 0
+    start_time = time.time()
+
+    # The extractors print progress information - this is left out of the timings
+    with open(os.devnull, "w") as devnull:
+        for file_path in docx_files:
+            timer = {"step": None, "start": time.perf_counter()}
+
+            def on_step(step_name):
+                now = time.perf_counter()
+                if timer["step"] is not None:
+                    step_times[timer["step"]] = step_times.get(timer["step"], 0) + now - timer["start"]
+                timer["step"] = step_name
+                timer["start"] = now
+
+            try:
+                with contextlib.redirect_stdout(devnull):
+                    extract_document(file_path, args.keywords, args.organ_keywords, args.keyword_ct, on_step=on_step)
+                on_step("done")
+                num_files += 1
+            except Exception as e:
+                print(f"Error processing {os.path.basename(file_path)}: {e}")
+
+    total_time = time.time() - start_time
+    print(f"{num_files} documents in {total_time:.2f} s ({num_files / total_time if total_time else 0:.1f} documents/s)")
+    print(f"{'Step':<22}{'Total (s)':>12}{'Per doc (ms)':>15}{'Share':>9}")
+    step_total = sum(step_times.values()) or 1
+    for step_name, seconds in sorted(step_times.items(), key=lambda item: -item[1]):
+        print(f"{step_name:<22}{seconds:>12.3f}{1000 * seconds / max(num_files, 1):>15.2f}{100 * seconds / step_total:>8.1f}%")
+
+def command_sample(args):
+    run_sample(args.folder, n=args.n, seed=args.seed, stratify=args.stratify, steps=args.steps, workers=args.workers, state_file=args.state_file,
+               keywords=args.keywords, organ_keywords=args.organ_keywords, keywordCT=args.keyword_ct, cache_file=args.cache)
+
+def command_index(args):
+    num_files = write_corpus_index(find_docx_files(args.folder), args.corpus)
+    print(f"Indexed {num_files} documents in {args.corpus}")
+
+def command_query(args):
+    flags = re.IGNORECASE if args.ignore_case else 0
+    result = query_corpus(args.corpus, re.compile(args.pattern, flags), scope=args.scope, samples=args.samples)
+    print(f"Documents with matches: {result['documents_matched']} of {result['documents']}")
+    print(f"Total matches: {result['matches']}")
+    for file_path, context in result["samples"]:
+        print(f"{os.path.basename(file_path)}: ...{context}...")
+
+def command_cache(args):
+    if args.reset:
+        connection = open_result_cache(args.cache)
+        connection.execute("DELETE FROM stats")
+        connection.commit()
+    print_cache_stats(args.cache)
+
+def command_expand(args):
+    num_rows = expand_csv(args.csv, args.text_store, args.output, file_names=set(args.files) if args.files else None)
+    print(f"Expanded {num_rows} rows to {args.output}")
+
+def command_serve(args):
+    serve_corpus(args.corpus, host=args.host, port=args.port, workers=args.workers)
+
+def command_aggregate(args):
+    aggregates = aggregate_files(args.inputs, value_columns=aggregate_value_columns + [keyword.lower() for keyword in args.keywords])
+    aggregates.write(args.output)
+    print(f"Wrote the aggregates of {aggregates.total['count']} records in {len(aggregates.groups)} groups to {args.output}")
+
+def command_diff(args):
+    result = diff_csv(args.old, args.new, samples=args.samples, encoding=args.encoding)
+    print(f"Rows: {result['old_rows']} old, {result['new_rows']} new - {result['changed']} changed, {result['unchanged']} unchanged,"
+          f" {len(result['added'])} added, {len(result['removed'])} removed")
+    for title, names in (("Added", result["added"]), ("Removed", result["removed"])):
+        if names:
+            print(f"{title}: {', '.join(names[:args.samples])}{' ...' if len(names) > args.samples else ''}")
+    for title, columns in (("Only in the old file", result["old_only_columns"]), ("Only in the new file", result["new_only_columns"])):
+        for column, count in columns.items():
+            print(f"{title}: {column} ({count} non-empty values)")
+    if result["column_changes"]:
+        print(f"{'Column':<30}{'Changed rows':>14}")
+        for column, count in result["column_changes"].items():
+            print(f"{column:<30}{count:>14}")
+    for column, samples in result["samples"].items():
+        print(f"\n{column}:")
+        for file_name, old, new in samples:
+            print(f"  {file_name}: {old!r} -> {new!r}")
+
+# Years as "1995", "2000-2005" or "unknown"
+def _parse_years(values):
+    years = set()
+    for value in values:
+        match = re.fullmatch(r"(\d{4})-(\d{4})", value)
+        if match:
+            years.update(str(year) for year in range(int(match.group(1)), int(match.group(2)) + 1))
+        else:
+            years.add(value)
+    return years
+
+def command_select(args):
+    num_rows = export_dataset_years(args.dataset, args.output, years=_parse_years(args.years) if args.years else None)
+    print(f"Wrote {num_rows} rows to {args.output}")
+
+def _add_keyword_arguments(parser):
+    parser.add_argument("--keywords", nargs="+", default=default_keywords, help="Organ weight keywords")
+    parser.add_argument("--organ-keywords", nargs="+", default=default_organ_keywords, help="Organ size keywords")
+    parser.add_argument("--keyword-ct", nargs="+", default=[default_keywordCT], help="Keywords to look for in CT paragraphs")
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Mine data from docx autopsy reports.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extract_parser = subparsers.add_parser("extract", help="Extract data from all docx-files in a folder to a CSV file")
+    extract_parser.add_argument("folder", nargs="?", default=default_folder_path)
+    extract_parser.add_argument("-o", "--output", default=default_output_csv_filename, help="Output CSV file")
+    extract_parser.add_argument("--cases", help="Also write one case record per autopsy (primary and supplementary reports linked) to this CSV file")
+    _add_keyword_arguments(extract_parser)
+    extract_parser.add_argument("--crawl-threads", type=int, default=8, help="Number of threads listing folders")
+    extract_parser.add_argument("--listing-cache", help="Cached folder listing (e.g. docx_listing.json) - only changed folders are listed again")
+    extract_parser.add_argument("--workers", type=int, default=0, help="Number of worker processes (0 = process the documents in the main process)")
+    extract_parser.add_argument("--unordered", action="store_true", help="With workers, output the documents in the order they are finished")
+    extract_parser.add_argument("--timeout", type=float, help="Run each document in a watchdog worker with this time limit (seconds)")
+    extract_parser.add_argument("--mem-limit", type=float, help="Memory limit (MB) for the watchdog worker")
+    extract_parser.add_argument("--quarantine-file", default="quarantine.csv", help="List of failing documents")
+    extract_parser.add_argument("--quarantine-policy", choices=["skip", "retry"], default="skip", help="Skip or retry documents quarantined in a previous run")
+    extract_parser.add_argument("--cache", help="Result cache file - steps are only run again for changed documents or changed steps")
+    extract_parser.add_argument("--cache-size-mb", type=float, default=1024, help="Size limit of the result cache (MB)")
+    extract_parser.add_argument("--memory-budget-mb", type=float, help="Memory for records in the main process - records beyond this are written to a spill file"
+                                " (the process memory is only checked if psutil is installed, and the workers are not included)")
+    extract_parser.add_argument("--spill-file", help="Spill file for records beyond the memory budget (default: a temporary file)")
+    extract_parser.add_argument("--text-store", help="Store the long text columns as references into this compressed text store (expand them with the expand command)")
+    extract_parser.add_argument("--progress-interval", type=float, default=5, help="Seconds between the progress updates")
+    extract_parser.add_argument("--status-file", help="Rewrite this JSON file with the progress (documents/s, MB/s, errors, queues, time left) at each update")
+    extract_parser.add_argument("-q", "--quiet", action="store_true", help="No output for each document and no progress lines (only the status file and the summary)")
+    extract_parser.add_argument("--dataset", help="Write the output as a dataset partitioned by autopsy year to this folder instead of one CSV file - only changed years are written")
+    extract_parser.add_argument("--aggregate", help="Write a summary file with counts, means and quantiles of the records by year, sex and age group")
+    extract_parser.add_argument("--paragraph-cache", help="Keep the results for repeated paragraphs (boilerplate) in this file for the next run")
+    extract_parser.set_defaults(func=command_extract)
+
+    bench_parser = subparsers.add_parser("bench", help="Time each extraction step")
+    bench_parser.add_argument("folder", nargs="?", default=default_folder_path)
+    bench_parser.add_argument("--limit", type=int, default=100, help="Number of documents")
+    _add_keyword_arguments(bench_parser)
+    bench_parser.set_defaults(func=command_bench)
+
+    sample_parser = subparsers.add_parser("sample", help="Run selected extraction steps on a stratified sample of documents")
+    sample_parser.add_argument("folder", nargs="?", default=default_folder_path)
+    sample_parser.add_argument("-n", type=int, default=200, help="Number of documents in the sample")
+    sample_parser.add_argument("--seed", type=int, default=1, help="Random seed - the same seed gives the same sample")
+    sample_parser.add_argument("--stratify", choices=["year", "folder", "size"], default="year")
+    sample_parser.add_argument("--steps", nargs="+", choices=[step_name for step_name, step in extraction_steps], help="Extraction steps to run (default: all)")
+    sample_parser.add_argument("--workers", type=int, default=0, help="Number of worker processes")
+    sample_parser.add_argument("--state-file", default="sample_state.json", help="Results of the previous sample run, used for the comparison")
+    sample_parser.add_argument("--cache", help="Result cache file")
+    _add_keyword_arguments(sample_parser)
+    sample_parser.set_defaults(func=command_sample)
+
+    index_parser = subparsers.add_parser("index", help="Store the paragraphs and table cells of all documents in a corpus file")
+    index_parser.add_argument("folder", nargs="?", default=default_folder_path)
+    index_parser.add_argument("--corpus", default="corpus.jsonl.gz", help="Corpus file")
+    index_parser.set_defaults(func=command_index)
+
+    query_parser = subparsers.add_parser("query", help="Search a corpus file with a regex")
+    query_parser.add_argument("pattern")
+    query_parser.add_argument("--corpus", default="corpus.jsonl.gz", help="Corpus file")
+    query_parser.add_argument("--scope", choices=["paragraphs", "tables", "text"], default="paragraphs", help="Search each paragraph, each table cell or the concatenated text")
+    query_parser.add_argument("-i", "--ignore-case", action="store_true")
+    query_parser.add_argument("--samples", type=int, default=10, help="Number of sample hits to show")
+    query_parser.set_defaults(func=command_query)
+
+    cache_parser = subparsers.add_parser("cache", help="Show the hit rates of the result cache")
+    cache_parser.add_argument("cache", help="Result cache file")
+    cache_parser.add_argument("--reset", action="store_true", help="Reset the hit statistics")
+    cache_parser.set_defaults(func=command_cache)
+
+    expand_parser = subparsers.add_parser("expand", help="Replace the text references in a CSV file by the full text")
+    expand_parser.add_argument("csv", help="CSV file from extract --text-store")
+    expand_parser.add_argument("--text-store", required=True, help="Text store used by extract")
+    expand_parser.add_argument("-o", "--output", required=True, help="Output CSV file")
+    expand_parser.add_argument("--files", nargs="+", help="Only expand the rows for these file names")
+    expand_parser.set_defaults(func=command_expand)
+
+    serve_parser = subparsers.add_parser("serve", help="Keep a corpus file in memory and answer pattern queries and step diffs over HTTP")
+    serve_parser.add_argument("--corpus", default="corpus.jsonl.gz", help="Corpus file")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="Address to listen on - requests can run code, so only use addresses on trusted networks")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument("--workers", type=int, help="Number of worker processes (default: number of CPUs)")
+    serve_parser.set_defaults(func=command_serve)
+
+    aggregate_parser = subparsers.add_parser("aggregate", help="Summarize CSV files from extract and merge summary files")
+    aggregate_parser.add_argument("inputs", nargs="+", help="CSV files from extract and summary files (.json) from extract --aggregate")
+    aggregate_parser.add_argument("-o", "--output", required=True, help="Output summary file (.json)")
+    aggregate_parser.add_argument("--keywords", nargs="+", default=default_keywords, help="Organ weight keywords (for the CSV files)")
+    aggregate_parser.set_defaults(func=command_aggregate)
+
+    diff_parser = subparsers.add_parser("diff", help="Compare the output CSV files of two runs")
+    diff_parser.add_argument("old", help="CSV file of the previous run")
+    diff_parser.add_argument("new", help="CSV file of the new run")
+    diff_parser.add_argument("--samples", type=int, default=5, help="Number of sample differences to show for each column")
+    diff_parser.add_argument("--encoding", default="utf-16", help="Encoding of the CSV files")
+    diff_parser.set_defaults(func=command_diff)
+
+    select_parser = subparsers.add_parser("select", help="Write the selected years of a dataset to one CSV file")
+    select_parser.add_argument("dataset", help="Dataset folder from extract --dataset")
+    select_parser.add_argument("--years", nargs="+", help="Years, e.g. 1995 2000-2005 unknown (default: all years)")
+    select_parser.add_argument("-o", "--output", required=True, help="Output CSV file")
+    select_parser.set_defaults(func=command_select)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
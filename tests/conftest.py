@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The extractor is a single script in the repository root - make it importable as a module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+import aut_erkl_extract_docx_250829 as extractor
+
+
+def record(file_name, cpr_number, aut_number, status, date="2001-02-03"):
+    return {"File Name": file_name, "CPR Number": cpr_number, "aut_number": aut_number, "Autopsy Date": date, "Prim_status": status}
+
+
+def case_records(data):
+    records, case_keys = extractor.link_case_records(data, list(data[0]))
+    return list(records)
+
+
+def test_supplementary_report_with_same_cpr_and_aut_number_is_linked():
+    data = [record("a.docx", "0101011234", "123/01", "Prim"), record("a_supp.docx", "0101011234", "123/01", "Supp")]
+    cases = case_records(data)
+    assert len(cases) == 1
+    assert cases[0]["Case status"] == "Prim"
+    assert cases[0]["File Name"] == "a.docx"
+    assert cases[0]["Linked supp"] == 1
+    assert cases[0]["Link method"] == "CPR+aut_number"
+    assert cases[0]["Supp 1: File Name"] == "a_supp.docx"
+
+
+def test_duplicate_supplementary_reports_are_removed():
+    data = [record("a.docx", "0101011234", "123/01", "Prim"), record("a_supp_1.docx", "0101011234", "123/01", "Supp"),
+            record("a_supp_2.docx", "0101011234", "123/01", "Supp")]
+    cases = case_records(data)
+    assert len(cases) == 1
+    assert cases[0]["Linked supp"] == 1
+    assert cases[0]["Supp 1: File Name"] == "a_supp_2.docx"
+
+
+def test_supplementary_report_without_primary_report_is_unlinked():
+    data = [record("a.docx", "0101011234", "123/01", "Prim"), record("b_supp.docx", "0202025678", "456/02", "Supp")]
+    cases = case_records(data)
+    assert [case["Case status"] for case in cases] == ["Prim", "Supp only"]
+    assert cases[1]["Supp 1: File Name"] == "b_supp.docx"
+
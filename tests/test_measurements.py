@@ -0,0 +1,64 @@
+import pytest
+
+import aut_erkl_extract_docx_250829 as extractor
+
+internal = "Indvendig undersøgelse. "
+
+# Sentence: the measurement columns with a value. The expected values are those of the regexes that extract_measurements replaced
+# (extract_lung_weights, extract_organ_size, extract_wall_thicknesses, extract_pleural_fluid and extract_height_weight)
+same_as_regexes = [
+    (internal + "Leveren vejer 1800 g.", {"leveren": 1800}),
+    (internal + "Leveren vejer 1.800 g.", {}),
+    (internal + "Leveren vejer ca. 1800 g.", {"leveren": 1800}),
+    (internal + "Hjertet vejer ca. 350 g.", {"hjerte": 350}),
+    (internal + "Hjertet vejer 350 gram.", {"hjerte": 350}),
+    (internal + "Hjertet vejer 350g.", {"hjerte": 350}),
+    (internal + "Hjertet vejer 5 g.", {}),
+    (internal + "Hjertet vejer 350,5 g.", {}),
+    (internal + "Milten vejer 150-200 g.", {"milt": 200}),
+    (internal + "Hjernen vejer mellem 1300 og 1400 g.", {"hjernen": 1400}),
+    (internal + "Venstre lunge vejer 540 g. Højre lunge vejer 650 g.", {"venstre lunge": 540, "højre lunge": 650}),
+    (internal + "Hjertet og leveren vejer 300 g og 1800 g.", {"hjerte": 300}),
+    (internal + "Hjertet vejer 420 g, ingen væskeansamling i hjerteposen.", {}),
+    (internal + "Hjertet vejer 420 g. Der er 30 ml væske i hjerteposen.", {"hjerte": 420}),
+    (internal + "Der er bristet kar i venstre lunge der vejer 700 g.", {"venstre lunge": 700}),
+    ("Leveren vejer 1800 g.", {}),
+    (internal + "Leveren vejer 1800 g og måler 25 x 18 x 8 cm.",
+     {"leveren": 1800, "Leveren_højde": 25.0, "Leveren_bredde": 18.0, "Leveren_dybde": 8.0}),
+    (internal + "Hjertet måler 12 x 10,5 x 6 cm.", {"Hjertet_højde": 12.0, "Hjertet_bredde": 10.5, "Hjertet_dybde": 6.0}),
+    (internal + "Højre nyre 11 x 6 x 4 cm.", {}),
+    (internal + "Leveren er blød med et hæmatom på 3 x 2 x 1 cm.", {}),
+    (internal + "Højre hjertekammer væg måler 4 mm.", {"højre hjertekammer": 4}),
+    (internal + "Hjerteskille 12 mm.", {"hjerteskille": 12}),
+    (internal + "I højre lungehule ses 200 ml væske og 50 ml i venstre.", {"højre": 200, "venstre": 50}),
+    (internal + "200 ml væske i højre lungehule.", {"højre": 200}),
+    (internal + "Bughule indeholder 30 ml klar væske.", {"bughule": 30}),
+    (internal + "Højre lungehule indeholder 1.200 ml.", {}),
+    ("Højden er 178 cm og vægten er 82,5 kg.", {"Højde": 178, "Vægt": 82, "Vægtenhed": "kg"}),
+    ("Højden er 178 cm, vægten er 75 kg.", {"Højde": 178, "Vægt": 75, "Vægtenhed": "kg"}),
+    ("Vægten er 3500 g.", {"Vægt": 3500, "Vægtenhed": "g"}),
+    ("Vægt 75 kilo.", {"Vægt": 75, "Vægtenhed": "kg"}),
+    ("Vægt ca. 75 kg.", {}),
+    ("Højde 1.78 m.", {}),
+    ("Såret findes i højde med navlen, 110 cm fra fodsålen.", {}),
+]
+
+# Sentences where extract_measurements deliberately differs from the regexes it replaced (the value of the regexes in the comment)
+different_from_regexes = [
+    (internal + "Leveren vejer 1,800 g.", {}),  # leveren=800
+    (internal + "Hjertet vejer 12345 g.", {}),  # hjerte=2345
+    (internal + "Venstre hjertekammer 1,4 mm.", {"venstre hjertekammer": 1.4}),  # 4
+    (internal + "Højre nyre måler 11x6x4 cm.", {"Højre nyre_højde": 11.0, "Højre nyre_bredde": 6.0, "Højre nyre_dybde": 4.0}),  # no size
+    (internal + "Leveren måler ca. 25 x 18 x 8 cm.", {"Leveren_højde": 25.0, "Leveren_bredde": 18.0, "Leveren_dybde": 8.0}),  # no size
+    (internal + "Hjerteposen der vejer 30 g er tom.", {}),  # hjerte=30
+]
+
+
+def measurements(text):
+    columns = extractor.extract_measurements(text, extractor.default_keywords, extractor.default_organ_keywords)
+    return {column: value for column, value in columns.items() if value is not None}
+
+
+@pytest.mark.parametrize("text, expected", same_as_regexes + different_from_regexes)
+def test_extract_measurements(text, expected):
+    assert measurements(text) == expected
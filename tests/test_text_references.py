@@ -0,0 +1,48 @@
+import pytest
+
+import aut_erkl_extract_docx_250829 as extractor
+
+paragraphs = [
+    "Konklusion: Dødsårsagen må antages at være hjertesygdom. Der var ingen tegn på vold. Afdøde var 60 år.",
+    "Indvendig undersøgelse.",
+    "Hjerteposen er glat.",
+    "Hjertet vejer 420 g og farven er rødbrun.",
+    "Legemspulsåren og dens grene er glatte.",
+    "Leveren vejer 1800 g.",
+    "Der er taget strip-test.",
+    "Strip-testen var negativ.",
+    "Slut.",
+]
+
+
+@pytest.fixture
+def document():
+    doc = extractor.corpus_document({"paragraphs": paragraphs, "tables": []})
+    ctx = {"doc": doc, "doc_text": " ".join(paragraphs)}
+    return ctx
+
+
+@pytest.mark.parametrize("step, column", [
+    (extractor.step_organ_descriptions, "Hjertebeskrivelse"),
+    (extractor.step_organ_descriptions, "Aortabeskrivelse"),
+    (extractor.step_organ_descriptions, "Leverbeskrivelse"),
+    (extractor.step_COD_text, "COD tekst"),
+    (extractor.step_strip, "Strip_text"),
+])
+def test_reference_from_step_spans(document, step, column):
+    columns = step(document)
+    value = columns[column]
+    reference = extractor.text_reference("0123456789ab", document["doc_text"], value, columns[f"_spans:{column}"])
+    assert reference.startswith("@0123456789ab:")
+    assert extractor.expand_text_reference(reference, None, {"0123456789ab": document["doc_text"]}) == value
+
+
+def test_reference_from_search(document):
+    value = paragraphs[4] + " / " + paragraphs[5]
+    reference = extractor.text_reference("0123456789ab", document["doc_text"], value)
+    assert extractor.expand_text_reference(reference, None, {"0123456789ab": document["doc_text"]}) == value
+
+
+def test_value_that_is_not_in_the_text_is_kept(document):
+    assert extractor.text_reference("0123456789ab", document["doc_text"], "Hjertet vejer 500 g") is None
+    assert extractor.text_reference("0123456789ab", document["doc_text"], "Hjerteposen er glat.", [[(0, 5)]]) is None